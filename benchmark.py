@@ -0,0 +1,457 @@
+"""
+Benchmarks for the metadata and map hot paths over a synthetic corpus.
+
+The corpus is generated deterministically from a seed, so runs on different
+machines or revisions time exactly the same files. Results are written as json
+and can be compared against a saved baseline:
+
+    python benchmark.py --scales 1000 10000 --output results.json
+    python benchmark.py --baseline baseline.json --save-baseline
+    python benchmark.py --baseline baseline.json --threshold 0.2
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+from time import perf_counter, time
+from typing import Callable
+
+from geo import (
+    GPS,
+    Coordinates,
+    create_sidecars,
+    get_gps_data,
+    get_image_gps,
+    images_extensions,
+    process_dir,
+)
+
+places = [
+    "Lisbon",
+    "Porto",
+    "Paris",
+    "Rome",
+    "Kyoto",
+    "Fiji",
+    "Anchorage",
+    "Sao Paulo",
+    "Cape Town",
+    "Reykjavik",
+]
+
+# ( extension, weight, tiff based, dng version tag )
+file_kinds = [
+    (".jpg", 50, False, False),
+    (".tif", 15, True, False),
+    (".dng", 35, True, True),
+]
+
+base_date = datetime(2019, 1, 1)
+
+
+def _entry(tag: int, type_: int, count: int, payload: bytes) -> tuple:
+    return (tag, type_, count, payload)
+
+
+def _ascii(tag: int, text: str) -> tuple:
+    data = text.encode() + b"\0"
+    return _entry(tag, 2, len(data), data)
+
+
+def _short(tag: int, value: int) -> tuple:
+    return _entry(tag, 3, 1, struct.pack("<H", value))
+
+
+def _long(tag: int, value: int) -> tuple:
+    return _entry(tag, 4, 1, struct.pack("<I", value))
+
+
+def _rationals(tag: int, values: list) -> tuple:
+    data = b"".join(
+        struct.pack("<II", value.numerator, value.denominator) for value in values
+    )
+    return _entry(tag, 5, len(values), data)
+
+
+def _ifd(entries: list[tuple], offset: int) -> bytes:
+    """
+    Serializes a little endian TIFF IFD placed at the given offset, values that
+    do not fit the entry are stored right after it
+    """
+    entries = sorted(entries)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    head = struct.pack("<H", len(entries))
+    extra = b""
+
+    for tag, type_, count, payload in entries:
+        if len(payload) <= 4:
+            value = payload.ljust(4, b"\0")
+        else:
+            value = struct.pack("<I", data_offset + len(extra))
+            extra += payload + (b"\0" if len(payload) % 2 else b"")
+        head += struct.pack("<HHI", tag, type_, count) + value
+
+    return head + struct.pack("<I", 0) + extra
+
+
+def _gps_entries(coordinates: Coordinates) -> list[tuple]:
+    gps = GPS.from_decimal(coordinates.latitude, coordinates.longitude)
+    return [
+        _entry(0x0000, 1, 4, bytes([2, 3, 0, 0])),
+        _ascii(0x0001, gps.latitude_degrees.quad),
+        _rationals(0x0002, gps.latitude_degrees[:3]),
+        _ascii(0x0003, gps.longitude_degrees.quad),
+        _rationals(0x0004, gps.longitude_degrees[:3]),
+        _ascii(0x0012, "WGS-84"),
+    ]
+
+
+def tiff_data(
+    coordinates: Coordinates | None, date_time: str, image: bool, dng: bool
+) -> bytes:
+    """
+    Builds a TIFF structure with an optional GPS IFD. With image set it is a
+    complete 1x1 grayscale file, otherwise only the metadata used inside a JPEG
+    APP1 segment
+    """
+
+    def ifd0_entries(gps_offset: int, strip_offset: int) -> list[tuple]:
+        entries = [_ascii(0x0132, date_time)]
+        if image:
+            entries += [
+                _long(0x0100, 1),
+                _long(0x0101, 1),
+                _short(0x0102, 8),
+                _short(0x0103, 1),
+                _short(0x0106, 1),
+                _long(0x0111, strip_offset),
+                _short(0x0115, 1),
+                _long(0x0116, 1),
+                _long(0x0117, 1),
+            ]
+        if dng:
+            entries.append(_entry(0xC612, 1, 4, bytes([1, 4, 0, 0])))
+        if coordinates:
+            entries.append(_long(0x8825, gps_offset))
+        return entries
+
+    ifd0 = _ifd(ifd0_entries(0, 0), 8)
+    gps_offset = 8 + len(ifd0)
+    gps = _ifd(_gps_entries(coordinates), gps_offset) if coordinates else b""
+    strip_offset = gps_offset + len(gps)
+    ifd0 = _ifd(ifd0_entries(gps_offset, strip_offset), 8)
+
+    return b"II*\0" + struct.pack("<I", 8) + ifd0 + gps + (b"\x80" if image else b"")
+
+
+def _segment(marker: int, payload: bytes) -> bytes:
+    return struct.pack(">HH", 0xFF00 | marker, len(payload) + 2) + payload
+
+
+# 8x8 mid gray baseline JPEG: every DC difference and AC run is coded with the
+# single one bit code of its huffman table
+jpeg_body = b"".join(
+    [
+        _segment(0xDB, b"\0" + b"\1" * 64),
+        _segment(0xC0, struct.pack(">BHHB", 8, 8, 8, 1) + bytes([1, 0x11, 0])),
+        _segment(0xC4, b"\x00" + bytes([1] + [0] * 15) + b"\x00"),
+        _segment(0xC4, b"\x10" + bytes([1] + [0] * 15) + b"\x00"),
+        _segment(0xDA, bytes([1, 1, 0x00, 0, 63, 0])),
+        b"\x3f\xff\xd9",
+    ]
+)
+
+
+def jpeg_data(coordinates: Coordinates | None, date_time: str) -> bytes:
+    exif = b"Exif\0\0" + tiff_data(coordinates, date_time, image=False, dng=False)
+    return b"\xff\xd8" + _segment(0xE1, exif) + jpeg_body
+
+
+def xmp_coordinate(value: float, positive: str, negative: str) -> str:
+    degrees, minutes = divmod(abs(value) * 60, 60)
+    return f"{int(degrees)},{minutes:.6f}{negative if value < 0 else positive}"
+
+
+def sidecar_data(coordinates: Coordinates | None) -> str:
+    gps = ""
+    if coordinates:
+        gps = (
+            f"exif:GPSLatitude='{xmp_coordinate(coordinates.latitude, 'N', 'S')}' "
+            f"exif:GPSLongitude='{xmp_coordinate(coordinates.longitude, 'E', 'W')}' "
+            "exif:GPSMapDatum='WGS-84'"
+        )
+    return f"""<?xml version='1.0' encoding='UTF-8'?>
+<x:xmpmeta xmlns:x='adobe:ns:meta/'>
+<rdf:RDF xmlns:rdf='http://www.w3.org/1999/02/22-rdf-syntax-ns#'>
+<rdf:Description rdf:about='' xmlns:exif='http://ns.adobe.com/exif/1.0/' {gps}/>
+</rdf:RDF>
+</x:xmpmeta>
+"""
+
+
+def generate_corpus(
+    root: Path,
+    count: int,
+    seed: int = 42,
+    files_per_folder: int = 100,
+    folders_per_parent: int = 10,
+    gps_ratio: float = 0.6,
+    sidecar_ratio: float = 0.2,
+) -> list[Path]:
+    """
+    Generates count image files under root, grouped into leaf folders of
+    files_per_folder images nested folders_per_parent to a parent. The same
+    arguments always produce the same files, a manifest is used to skip the
+    generation when the corpus already exists
+    """
+    parameters = {
+        "count": count,
+        "seed": seed,
+        "files_per_folder": files_per_folder,
+        "folders_per_parent": folders_per_parent,
+        "gps_ratio": gps_ratio,
+        "sidecar_ratio": sidecar_ratio,
+    }
+    manifest = root / "manifest.json"
+    if manifest.exists() and json.loads(manifest.read_text()) == parameters:
+        return sorted(
+            path for path in root.rglob("*") if path.suffix in images_extensions
+        )
+
+    if root.exists():
+        shutil.rmtree(root)
+
+    rng = random.Random(seed)
+    kinds = [kind for kind in file_kinds for _ in range(kind[1])]
+    files = []
+
+    for index in range(count):
+        folder_index = index // files_per_folder
+        place = places[folder_index % len(places)]
+        day = base_date + timedelta(days=folder_index)
+        folder = (
+            root
+            / f"{2019 + folder_index // (folders_per_parent ** 2)}"
+            / f"Group {folder_index // folders_per_parent % folders_per_parent:02d}"
+            / f"{day:%Y %m %d} {place}"
+        )
+        folder.mkdir(parents=True, exist_ok=True)
+
+        suffix, _, tiff, dng = rng.choice(kinds)
+        taken = day + timedelta(seconds=index % files_per_folder * 30)
+        date_time = f"{taken:%Y:%m:%d %H:%M:%S}"
+        coordinates = None
+        if rng.random() < gps_ratio:
+            coordinates = Coordinates(
+                round(rng.uniform(-80, 80), 6), round(rng.uniform(-180, 180), 6)
+            )
+
+        path = folder / f"IMG_{index:06d}{suffix}"
+        if tiff:
+            path.write_bytes(tiff_data(coordinates, date_time, image=True, dng=dng))
+        else:
+            path.write_bytes(jpeg_data(coordinates, date_time))
+
+        if rng.random() < sidecar_ratio:
+            sidecar_gps = None
+            if rng.random() < gps_ratio:
+                sidecar_gps = Coordinates(
+                    round(rng.uniform(-80, 80), 6), round(rng.uniform(-180, 180), 6)
+                )
+            path.with_suffix(f"{path.suffix}.xmp").write_text(sidecar_data(sidecar_gps))
+
+        timestamp = taken.timestamp()
+        os.utime(path, (timestamp, timestamp))
+        files.append(path)
+
+    manifest.write_text(json.dumps(parameters))
+    return files
+
+
+def measure(
+    func: Callable, items: int, repeat: int, setup: Callable | None = None
+) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        begin = perf_counter()
+        func()
+        timings.append(perf_counter() - begin)
+
+    median = statistics.median(timings)
+    return {
+        "seconds": median,
+        "min_seconds": min(timings),
+        "items": items,
+        "per_item_us": median / items * 1e6 if items else 0,
+    }
+
+
+def run_scale(
+    root: Path, count: int, repeat: int, seed: int, max_markers: int
+) -> dict[str, dict]:
+    files = generate_corpus(root, count, seed=seed)
+    results = {}
+    rng = random.Random(seed)
+
+    def read_all():
+        for file in files:
+            get_gps_data(file)
+
+    def image_gps_all():
+        for file in files:
+            get_image_gps(file)
+
+    results["get_gps_data"] = measure(read_all, len(files), repeat)
+    results["get_image_gps_cold"] = measure(
+        image_gps_all, len(files), repeat, setup=get_image_gps.cache_clear
+    )
+    # only as many files as get_image_gps caches stay warm between passes
+    cached = files[: get_image_gps.cache_info().maxsize]
+
+    def image_gps_cached():
+        for file in cached:
+            get_image_gps(file)
+
+    image_gps_cached()
+    results["get_image_gps_warm"] = measure(image_gps_cached, len(cached), repeat)
+
+    leaves = sorted({file.parent for file in files})
+    results["process_dir"] = measure(lambda: process_dir(root), len(leaves), repeat)
+
+    def remove_new_sidecars():
+        for sidecar in root.rglob("*.xmp"):
+            if sidecar not in existing_sidecars:
+                sidecar.unlink()
+
+    existing_sidecars = set(root.rglob("*.xmp"))
+    data = [
+        (str(leaf), rng.uniform(-80, 80), rng.uniform(-180, 180)) for leaf in leaves
+    ]
+    results["create_sidecars"] = measure(
+        lambda: create_sidecars(data), len(files), repeat, setup=remove_new_sidecars
+    )
+    remove_new_sidecars()
+
+    decimals = [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(count)]
+    gps_list = [GPS.from_decimal(*value) for value in decimals]
+    exif_list = [
+        (
+            gps.latitude_to_exif(),
+            gps.latitude_degrees.quad,
+            gps.longitude_to_exif(),
+            gps.longitude_degrees.quad,
+        )
+        for gps in gps_list
+    ]
+    results["gps_from_decimal"] = measure(
+        lambda: [GPS.from_decimal(*value) for value in decimals], count, repeat
+    )
+    results["gps_to_exif"] = measure(
+        lambda: [gps.to_exif() for gps in gps_list], count, repeat
+    )
+    results["gps_from_exif"] = measure(
+        lambda: [GPS.from_exif(*value) for value in exif_list], count, repeat
+    )
+
+    from map import map_html
+
+    markers = [gps.coordinates for gps in gps_list[:max_markers]]
+    results["map_html"] = measure(lambda: map_html(markers), len(markers), repeat)
+
+    return results
+
+
+def compare(
+    results: dict, baseline: dict, threshold: float
+) -> list[tuple[str, str, float]]:
+    """
+    Returns the ( scale, benchmark, ratio ) of every benchmark slower than the
+    baseline by more than threshold
+    """
+    regressions = []
+    for scale, benchmarks in results["results"].items():
+        for name, values in benchmarks.items():
+            previous = baseline["results"].get(scale, {}).get(name)
+            if not previous or not previous["seconds"]:
+                continue
+            ratio = values["seconds"] / previous["seconds"]
+            print(f"{scale:>8} {name:<22} {values['seconds']:10.4f}s {ratio:6.2f}x")
+            if ratio > 1 + threshold:
+                regressions.append((scale, name, ratio))
+
+    return regressions
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--corpus",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "smartgeotag-benchmark",
+    )
+    parser.add_argument("--max-markers", type=int, default=1000)
+    parser.add_argument("--output", type=Path, default=Path("benchmark_results.json"))
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = {
+        "meta": {
+            "timestamp": time(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "max_markers": args.max_markers,
+            "image_gps_cache_size": get_image_gps.cache_info().maxsize,
+        },
+        "results": {},
+    }
+
+    for scale in args.scales:
+        print(f"Running benchmarks with {scale} files...")
+        results["results"][str(scale)] = run_scale(
+            args.corpus / f"scale-{scale}",
+            scale,
+            args.repeat,
+            args.seed,
+            args.max_markers,
+        )
+
+    args.output.write_text(json.dumps(results, indent=2))
+    print(f"Results written to {args.output}")
+
+    if not args.baseline:
+        return 0
+
+    if args.save_baseline or not args.baseline.exists():
+        args.baseline.write_text(json.dumps(results, indent=2))
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    regressions = compare(
+        results, json.loads(args.baseline.read_text()), args.threshold
+    )
+    for scale, name, ratio in regressions:
+        print(f"Regression: {name} at {scale} files is {ratio:.2f}x slower")
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,539 @@
+"""
+Metadata index of the scanned images.
+
+Keeps one row per image with its size, modification times, coordinates and
+capture time in a sqlite database, so views, filters and sorting never have to
+touch the filesystem. Rows are synced from a folder listing first and have
+their metadata read afterwards, only when the file or its sidecar changed.
+Content fingerprints identify copies of the same file, whose metadata is read
+only once.
+"""
+
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+
+from fingerprint import metadata_sampled, quick_hash
+from geo import Coordinates, get_image_metadata, images_extensions, read_metadata
+import instrumentation
+from instrumentation import instrument
+from siblings import group_siblings
+
+default_path = Path(
+    os.environ.get(
+        "SMARTGEOTAG_CATALOG", Path.home() / ".smartgeotag" / "catalog.sqlite3"
+    )
+)
+
+commit_size = 200
+
+# each entry upgrades the schema by one version, the applied version is kept in
+# the database user_version
+migrations = [
+    """
+    CREATE TABLE images (
+        path TEXT PRIMARY KEY,
+        folder TEXT NOT NULL,
+        name TEXT NOT NULL,
+        suffix TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        sidecar_mtime REAL,
+        scanned INTEGER NOT NULL DEFAULT 0,
+        latitude REAL,
+        longitude REAL,
+        taken TEXT
+    );
+    CREATE INDEX images_folder_name ON images (folder, name);
+    CREATE INDEX images_folder_taken ON images (folder, taken);
+    """,
+    """
+    ALTER TABLE images ADD COLUMN quick_hash TEXT;
+    ALTER TABLE images ADD COLUMN full_hash TEXT;
+    CREATE INDEX images_size ON images (size, quick_hash);
+    CREATE INDEX images_full_hash ON images (full_hash);
+    """,
+]
+
+sort_columns = {
+    "name": "name",
+    "size": "size",
+    "suffix": "suffix",
+    "taken": "taken",
+    "tagged": "latitude IS NOT NULL",
+}
+
+
+class Record(NamedTuple):
+    path: str
+    name: str
+    suffix: str
+    size: int
+    mtime: float
+    taken: str | None
+    latitude: float | None
+    longitude: float | None
+    scanned: bool
+
+    @property
+    def coordinates(self) -> Coordinates | None:
+        if self.latitude is None or self.longitude is None:
+            return None
+        return Coordinates(self.latitude, self.longitude)
+
+
+record_columns = ", ".join(Record._fields)
+
+
+class Filter(NamedTuple):
+    """
+    Restricts the rows of a folder: tagged True / False keeps only images with
+    or without coordinates, start / end are inclusive capture dates
+    ( 2019-01-31 ) and bbox ( south, west, north, east ) keeps the images
+    inside it, crossing the antimeridian when west is greater than east
+    """
+
+    tagged: bool | None = None
+    start: str | None = None
+    end: str | None = None
+    bbox: tuple[float, float, float, float] | None = None
+
+    def where(self) -> tuple[str, list]:
+        clauses, parameters = [], []
+        if self.tagged is not None:
+            clauses.append(f"latitude IS {'NOT ' if self.tagged else ''}NULL")
+        if self.start:
+            clauses.append("taken >= ?")
+            parameters.append(self.start)
+        if self.end:
+            clauses.append("taken < ?")
+            parameters.append(f"{self.end}~")
+        if self.bbox:
+            south, west, north, east = self.bbox
+            clauses.append("latitude BETWEEN ? AND ?")
+            parameters += [south, north]
+            if west <= east:
+                clauses.append("longitude BETWEEN ? AND ?")
+            else:
+                clauses.append("(longitude >= ? OR longitude <= ?)")
+            parameters += [west, east]
+        return "".join(f" AND {clause}" for clause in clauses), parameters
+
+
+class Catalog:
+    def __init__(self, path: Path | str = default_path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._migrate()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """
+        sqlite connections can't be shared between threads, so each thread
+        gets its own
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _migrate(self):
+        with self.connection as connection:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for number, script in enumerate(migrations[version:], version + 1):
+                connection.executescript(script)
+                connection.execute(f"PRAGMA user_version = {number}")
+
+    @instrument("Catalog.sync_folder")
+    def sync_folder(self, folder: Path | str) -> int:
+        """
+        Matches the rows of a folder with its listing, adding new images,
+        dropping removed ones and flagging changed ones to be read again.
+        Returns the number of images in the folder
+        """
+        folder = str(folder)
+        files, sidecars = {}, {}
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    suffix = os.path.splitext(entry.name)[1].lower()
+                    if suffix == ".xmp":
+                        sidecars[entry.name[:-4]] = entry.stat().st_mtime
+                    elif suffix in images_extensions and entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (suffix, stat.st_size, stat.st_mtime)
+        except OSError as e:
+            print(f"Error listing folder {folder}: {e}")
+            return 0
+
+        existing = {
+            row[0]: row[1:]
+            for row in self.connection.execute(
+                "SELECT name, size, mtime, sidecar_mtime FROM images WHERE folder = ?",
+                (folder,),
+            )
+        }
+
+        changed = []
+        for name, (suffix, size, mtime) in files.items():
+            state = (size, mtime, sidecars.get(name))
+            if existing.get(name) != state:
+                changed.append(
+                    (os.path.join(folder, name), folder, name, suffix, *state)
+                )
+
+        removed = [
+            (os.path.join(folder, name),) for name in existing if name not in files
+        ]
+
+        with self.connection as connection:
+            connection.executemany(
+                """
+                INSERT INTO images (path, folder, name, suffix, size, mtime, sidecar_mtime)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET
+                    size = excluded.size,
+                    mtime = excluded.mtime,
+                    sidecar_mtime = excluded.sidecar_mtime,
+                    scanned = 0,
+                    quick_hash = CASE WHEN size = excluded.size
+                        AND mtime = excluded.mtime THEN quick_hash END,
+                    full_hash = CASE WHEN size = excluded.size
+                        AND mtime = excluded.mtime THEN full_hash END
+                """,
+                changed,
+            )
+            connection.executemany("DELETE FROM images WHERE path = ?", removed)
+
+        return len(files)
+
+    def invalidate(self, paths: list[str]):
+        """
+        Flags images to be read again, for changes the listing cannot see, as
+        GPS written into images keeping their size and modified time. Their
+        fingerprints are dropped too, so they are not matched to copies that
+        still have the previous metadata
+        """
+        with self.connection as connection:
+            connection.executemany(
+                "UPDATE images SET scanned = 0, quick_hash = NULL, full_hash = NULL "
+                "WHERE path = ?",
+                [(str(path),) for path in paths],
+            )
+
+    def pending(self, folder: Path | str, limit: int = -1) -> list[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT path FROM images WHERE folder = ? AND scanned = 0 "
+                "ORDER BY name LIMIT ?",
+                (str(folder), limit),
+            )
+        ]
+
+    def read_metadata(
+        self,
+        paths: list[str],
+        should_stop: Callable[[], bool] | None = None,
+        progress: Callable[[int], None] | None = None,
+    ) -> int:
+        """
+        Reads the coordinates and capture time of the images, committing every
+        commit_size images. Siblings of the same capture share the metadata of
+        the cheapest one to read, and copies of an image already read, without
+        sidecars, take its metadata instead of being parsed again. Copies are
+        only matched by the quick hash, without reading the whole files, for
+        JPEG files whose metadata lies in the sampled head. Returns the number
+        of images read
+        """
+        done = 0
+        updates, hashes = [], []
+        # metadata by ( size, quick hash ) of the copies read in this call
+        copies: dict[tuple[int, str], tuple] = {}
+        for group in group_siblings([Path(path) for path in paths]):
+            if should_stop and should_stop():
+                break
+
+            metadata = None
+            key = self._copy_key(str(group[0]), hashes) if len(group) == 1 else None
+            if key:
+                metadata = copies.get(key) or self._copy_metadata(key, str(group[0]))
+                instrumentation.cache_access("duplicates", metadata is not None)
+
+            if metadata:
+                updates.append((*metadata, str(group[0])))
+                done += 1
+            else:
+                shared = read_metadata(group[0]) if len(group) > 1 else None
+                for file in group:
+                    coordinates, taken = get_image_metadata(file, shared)
+                    latitude, longitude = coordinates if coordinates else (None, None)
+                    updates.append((latitude, longitude, taken, str(file)))
+                    done += 1
+
+                if key:
+                    copies[key] = updates[-1][:3]
+
+            if len(updates) >= commit_size:
+                self.store_hashes(hashes)
+                self._store_metadata(updates)
+                updates, hashes = [], []
+                if progress:
+                    progress(done)
+
+        self.store_hashes(hashes)
+        self._store_metadata(updates)
+        if progress:
+            progress(done)
+
+        return done
+
+    def _copy_key(self, path: str, hashes: list[tuple]) -> tuple[int, str] | None:
+        """
+        ( size, quick hash ) of an image without sidecar whose size is shared
+        with another image, None for the images that can't be copies or whose
+        metadata the quick hash does not cover. A quick hash computed is added
+        to hashes
+        """
+        row = self.connection.execute(
+            "SELECT size, sidecar_mtime, quick_hash FROM images WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if not row or row[1] is not None:
+            return None
+
+        size, _, quick = row
+        if not quick:
+            if not self.connection.execute(
+                "SELECT 1 FROM images WHERE size = ? AND path != ? LIMIT 1",
+                (size, path),
+            ).fetchone():
+                return None
+
+        if not metadata_sampled(path):
+            return None
+
+        if not quick:
+            quick = quick_hash(path, size)
+            if not quick:
+                return None
+            hashes.append((quick, None, path))
+
+        return size, quick
+
+    def _copy_metadata(self, key: tuple[int, str], path: str) -> tuple | None:
+        """
+        ( latitude, longitude, taken ) of a copy already read without sidecar
+        """
+        size, quick = key
+        metadata = self.connection.execute(
+            "SELECT latitude, longitude, taken FROM images WHERE size = ? "
+            "AND quick_hash = ? AND scanned = 1 AND sidecar_mtime IS NULL "
+            "AND path != ? LIMIT 1",
+            (size, quick, path),
+        ).fetchone()
+        if metadata:
+            return metadata
+
+        # copies read before their size was shared have no fingerprint yet
+        rows = self.connection.execute(
+            "SELECT path, latitude, longitude, taken FROM images WHERE size = ? "
+            "AND quick_hash IS NULL AND scanned = 1 AND sidecar_mtime IS NULL "
+            "AND path != ?",
+            (size, path),
+        ).fetchall()
+        hashes = [(quick_hash(row[0], size), None, row[0]) for row in rows]
+        self.store_hashes([item for item in hashes if item[0]])
+        for (other_quick, _, _), row in zip(hashes, rows):
+            if other_quick == quick:
+                return row[1:]
+
+        return None
+
+    def store_hashes(self, hashes: list[tuple]):
+        """
+        Stores ( quick hash, full hash, path ) fingerprints, a None full hash
+        keeping the current one
+        """
+        if not hashes:
+            return
+
+        with self.connection as connection:
+            connection.executemany(
+                "UPDATE images SET quick_hash = ?, "
+                "full_hash = COALESCE(?, full_hash) WHERE path = ?",
+                hashes,
+            )
+
+    def _store_metadata(self, updates: list[tuple]):
+        if not updates:
+            return
+
+        with self.connection as connection:
+            connection.executemany(
+                "UPDATE images SET latitude = ?, longitude = ?, taken = ?, scanned = 1 "
+                "WHERE path = ?",
+                updates,
+            )
+
+    def scan_folder(
+        self,
+        folder: Path | str,
+        should_stop: Callable[[], bool] | None = None,
+        progress: Callable[[int], None] | None = None,
+    ) -> int:
+        self.sync_folder(folder)
+        return self.read_metadata(self.pending(folder), should_stop, progress)
+
+    def count(self, folder: Path | str, filter: Filter = Filter()) -> int:
+        where, parameters = filter.where()
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM images WHERE folder = ?{where}",
+            [str(folder), *parameters],
+        ).fetchone()[0]
+
+    @instrument("Catalog.records")
+    def records(
+        self,
+        folder: Path | str,
+        filter: Filter = Filter(),
+        order: str = "name",
+        descending: bool = False,
+        offset: int = 0,
+        limit: int = -1,
+    ) -> list[Record]:
+        where, parameters = filter.where()
+        direction = "DESC" if descending else "ASC"
+        return [
+            Record(*row)
+            for row in self.connection.execute(
+                f"SELECT {record_columns} FROM images WHERE folder = ?{where} "
+                f"ORDER BY {sort_columns[order]} {direction}, name {direction} "
+                "LIMIT ? OFFSET ?",
+                [str(folder), *parameters, limit, offset],
+            )
+        ]
+
+    def record(self, path: Path | str) -> Record | None:
+        row = self.connection.execute(
+            f"SELECT {record_columns} FROM images WHERE path = ?", (str(path),)
+        ).fetchone()
+        return Record(*row) if row else None
+
+    def iter_records(
+        self, root: Path | str, recursive: bool = True, filter: Filter = Filter()
+    ) -> Iterator[Record]:
+        """
+        Streams the records of a folder, and with recursive of all its
+        subfolders, without loading them all in memory
+        """
+        root = str(root)
+        where, parameters = filter.where()
+        if recursive:
+            # subfolders sort between "root/" and the next character after the
+            # separator, so the folder index can be used
+            prefix = os.path.join(root, "")
+            upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            cursor = self.connection.execute(
+                f"SELECT {record_columns} FROM images "
+                f"WHERE (folder = ? OR (folder >= ? AND folder < ?)){where} "
+                "ORDER BY folder, name",
+                [root, prefix, upper, *parameters],
+            )
+        else:
+            cursor = self.connection.execute(
+                f"SELECT {record_columns} FROM images WHERE folder = ?{where} "
+                "ORDER BY name",
+                [root, *parameters],
+            )
+
+        for row in cursor:
+            yield Record(*row)
+
+    def shared_sizes(self) -> list[int]:
+        """
+        Sizes of more than one image, the only ones that can be copies
+        """
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT size FROM images GROUP BY size HAVING COUNT(*) > 1"
+            )
+        ]
+
+    def fingerprints(self, size: int) -> list[tuple[str, str | None, str | None]]:
+        """
+        ( path, quick hash, full hash ) of the images of a size
+        """
+        return self.connection.execute(
+            "SELECT path, quick_hash, full_hash FROM images WHERE size = ?", (size,)
+        ).fetchall()
+
+    def duplicate_groups(self) -> Iterator[list[Record]]:
+        """
+        Streams the groups of images with the same full hash
+        """
+        group, current = [], None
+        for full_hash, *row in self.connection.execute(
+            f"SELECT full_hash, {record_columns} FROM images WHERE full_hash IN "
+            "(SELECT full_hash FROM images WHERE full_hash IS NOT NULL "
+            "GROUP BY full_hash HAVING COUNT(*) > 1) ORDER BY full_hash, path"
+        ):
+            if full_hash != current and group:
+                yield group
+                group = []
+            current = full_hash
+            group.append(Record(*row))
+
+        if group:
+            yield group
+
+    def copies(self, path: Path | str) -> list[Record]:
+        """
+        Other images with the same content as path, once fingerprinted
+        """
+        return [
+            Record(*row)
+            for row in self.connection.execute(
+                f"SELECT {record_columns} FROM images WHERE full_hash = "
+                "(SELECT full_hash FROM images WHERE path = ?) AND path != ?",
+                (str(path), str(path)),
+            )
+        ]
+
+    def scan_tree(
+        self,
+        root: Path | str,
+        should_stop: Callable[[], bool] | None = None,
+    ) -> int:
+        """
+        Scans a folder and all its subfolders, returning the number of images
+        read
+        """
+        done = 0
+        for folder, _, _ in os.walk(root):
+            if should_stop and should_stop():
+                break
+            done += self.scan_folder(folder, should_stop)
+        return done
+
+
+_catalog: Catalog | None = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> Catalog:
+    """
+    The catalog shared by the application, created on first use
+    """
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog()
+        return _catalog
@@ -0,0 +1,445 @@
+"""
+Clustering of the photo locations into places and events.
+
+Points are converted to unit vectors, so distances, grids and centroids have no
+discontinuity at the antimeridian or the poles. Identical and very close points
+are first merged into weighted bins, which keeps DBSCAN fast on libraries with
+thousands of photos taken at the same spot, then a grid with cells the size of
+the search radius limits each neighbour search to the 27 surrounding cells.
+
+The resulting places, split into events by capture time, give per folder and
+per event centroids that are suggested for the untagged photos of a folder
+without any geocoding call.
+
+    python cluster.py ROOT --eps 1 --min-points 3 --apply
+"""
+
+import argparse
+import math
+import sys
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from catalog import Catalog, get_catalog
+from geo import Coordinates
+from journal import run_job
+from propagation import timestamp
+
+earth_radius_km = 6371.0
+default_eps_km = 1.0
+default_min_points = 3
+# capture time gap that splits a place into separate events
+event_gap = 12 * 3600
+# photos taken this close to an event are considered part of it
+event_margin = 6 * 3600
+
+Vector = tuple[float, float, float]
+
+
+class Cluster(NamedTuple):
+    label: int
+    centroid: Coordinates
+    count: int
+    bounds: tuple[Coordinates, Coordinates]
+
+
+class Event(NamedTuple):
+    label: int
+    centroid: Coordinates
+    count: int
+    start: float
+    end: float
+
+
+class Suggestion(NamedTuple):
+    folder: str
+    coordinates: Coordinates
+    # share of the photos used that agree with the suggested place
+    confidence: float
+    source: str
+    paths: list[str]
+
+
+def to_vector(coordinates: Coordinates) -> Vector:
+    latitude = math.radians(coordinates.latitude)
+    longitude = math.radians(coordinates.longitude)
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def from_vector(x: float, y: float, z: float) -> Coordinates:
+    return Coordinates(
+        math.degrees(math.atan2(z, math.hypot(x, y))), math.degrees(math.atan2(y, x))
+    )
+
+
+def spherical_center(coordinates: Iterable[Coordinates]) -> Coordinates:
+    """
+    Centroid of the coordinates on the sphere, correct across the antimeridian
+    """
+    x = y = z = 0.0
+    for coordinate in coordinates:
+        vx, vy, vz = to_vector(coordinate)
+        x += vx
+        y += vy
+        z += vz
+
+    if not (x or y or z):
+        return Coordinates(0, 0)
+
+    return from_vector(x, y, z)
+
+
+def longitude_range(longitudes: Iterable[float]) -> tuple[float, float]:
+    """
+    Smallest ( west, east ) longitude range containing all longitudes, found
+    by leaving out the largest gap between them. west is greater than east
+    when the range crosses the antimeridian
+    """
+    values = sorted(longitudes)
+    if not values:
+        return 0.0, 0.0
+
+    # gap from the last longitude around to the first one
+    largest_gap = values[0] + 360 - values[-1]
+    west, east = values[0], values[-1]
+    for previous, current in zip(values, values[1:]):
+        if current - previous > largest_gap:
+            largest_gap = current - previous
+            west, east = current, previous
+
+    return west, east
+
+
+def geo_bounds(
+    coordinates: list[Coordinates],
+) -> tuple[Coordinates, Coordinates]:
+    """
+    ( south west, north east ) corners of the coordinates, the west longitude
+    being greater than the east one when the bounds cross the antimeridian
+    """
+    west, east = longitude_range(coordinate.longitude for coordinate in coordinates)
+    latitudes = [coordinate.latitude for coordinate in coordinates]
+    return Coordinates(min(latitudes), west), Coordinates(max(latitudes), east)
+
+
+def chord(distance_km: float) -> float:
+    """
+    Straight line distance between unit vectors distance_km apart on earth
+    """
+    return 2 * math.sin(min(distance_km / earth_radius_km, math.pi) / 2)
+
+
+def cluster_points(
+    points: list[Coordinates],
+    eps_km: float = default_eps_km,
+    min_points: int = default_min_points,
+) -> list[int]:
+    """
+    Weighted DBSCAN over the points, returning the cluster label of each point
+    or -1 for noise
+    """
+    radius = chord(eps_km)
+    bin_size = radius / 4
+
+    # merge points closer than a quarter of the radius into weighted bins
+    bins: dict[tuple[int, int, int], list[float]] = {}
+    point_bins = []
+    for point in points:
+        vector = to_vector(point)
+        key = tuple(math.floor(value / bin_size) for value in vector)
+        entry = bins.get(key)
+        if entry is None:
+            entry = bins[key] = [0.0, 0.0, 0.0, 0]
+        entry[0] += vector[0]
+        entry[1] += vector[1]
+        entry[2] += vector[2]
+        entry[3] += 1
+        point_bins.append(key)
+
+    keys = list(bins)
+    vectors = [
+        (entry[0] / entry[3], entry[1] / entry[3], entry[2] / entry[3])
+        for entry in bins.values()
+    ]
+    weights = [entry[3] for entry in bins.values()]
+
+    grid: dict[tuple[int, int, int], list[int]] = defaultdict(list)
+    cells = []
+    for index, vector in enumerate(vectors):
+        cell = tuple(math.floor(value / radius) for value in vector)
+        grid[cell].append(index)
+        cells.append(cell)
+
+    offsets = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]
+    squared_radius = radius * radius
+
+    def neighbours(index: int) -> tuple[list[int], int]:
+        """
+        Bins within the radius of a bin and the amount of points they hold
+        """
+        x, y, z = vectors[index]
+        cx, cy, cz = cells[index]
+        result = []
+        weight = 0
+        for i, j, k in offsets:
+            for other in grid.get((cx + i, cy + j, cz + k), ()):
+                ox, oy, oz = vectors[other]
+                dx, dy, dz = x - ox, y - oy, z - oz
+                if dx * dx + dy * dy + dz * dz <= squared_radius:
+                    result.append(other)
+                    weight += weights[other]
+        return result, weight
+
+    labels = [-2] * len(vectors)
+    label = 0
+    for index in range(len(vectors)):
+        if labels[index] != -2:
+            continue
+
+        found, weight = neighbours(index)
+        if weight < min_points:
+            labels[index] = -1
+            continue
+
+        labels[index] = label
+        queue = found
+        while queue:
+            other = queue.pop()
+            if labels[other] == -1:
+                labels[other] = label
+            if labels[other] != -2:
+                continue
+            labels[other] = label
+            expansion, weight = neighbours(other)
+            if weight >= min_points:
+                queue.extend(expansion)
+        label += 1
+
+    bin_labels = dict(zip(keys, labels))
+    return [bin_labels[key] for key in point_bins]
+
+
+def agreeing(points: list[Coordinates], eps_km: float) -> list[Coordinates]:
+    """
+    Largest group of the points within eps_km of one of them
+    """
+    vectors = [to_vector(point) for point in points]
+    limit = chord(eps_km) ** 2
+    best: list[Coordinates] = []
+    for center in vectors:
+        group = [
+            point
+            for point, vector in zip(points, vectors)
+            if sum((a - b) ** 2 for a, b in zip(center, vector)) <= limit
+        ]
+        if len(group) > len(best):
+            best = group
+    return best
+
+
+def clusters(points: list[Coordinates], labels: list[int]) -> dict[int, Cluster]:
+    members: dict[int, list[Coordinates]] = defaultdict(list)
+    for point, label in zip(points, labels):
+        if label >= 0:
+            members[label].append(point)
+
+    return {
+        label: Cluster(label, spherical_center(items), len(items), geo_bounds(items))
+        for label, items in members.items()
+    }
+
+
+def events(
+    points: list[Coordinates], labels: list[int], times: list[float | None]
+) -> list[Event]:
+    """
+    Splits every cluster into events wherever its photos are more than
+    event_gap apart in time
+    """
+    members: dict[int, list[tuple[float, Coordinates]]] = defaultdict(list)
+    for point, label, seconds in zip(points, labels, times):
+        if label >= 0 and seconds is not None:
+            members[label].append((seconds, point))
+
+    result = []
+    for label, items in members.items():
+        items.sort(key=lambda item: item[0])
+        current = [items[0]]
+        for item in items[1:]:
+            if item[0] - current[-1][0] > event_gap:
+                result.append(_event(label, current))
+                current = []
+            current.append(item)
+        result.append(_event(label, current))
+
+    result.sort(key=lambda event: event.start)
+    return result
+
+
+def _event(label: int, items: list[tuple[float, Coordinates]]) -> Event:
+    return Event(
+        label,
+        spherical_center(point for _, point in items),
+        len(items),
+        items[0][0],
+        items[-1][0],
+    )
+
+
+def suggest_locations(
+    root: Path | str,
+    catalog: Catalog | None = None,
+    eps_km: float = default_eps_km,
+    min_points: int = default_min_points,
+) -> list[Suggestion]:
+    """
+    Suggests a location for the untagged photos of every folder under root.
+    Folders with tagged photos get the centroid of their photos in the place
+    most of them belong to, or of the largest group of them within eps_km when
+    they are too few to form a place and none when they all disagree, with the
+    share of the photos in it as confidence. The untagged photos of other
+    folders get the event of a sibling folder they were taken during
+    """
+    catalog = catalog or get_catalog()
+
+    points, point_folders, times = [], [], []
+    untagged: dict[str, list[tuple[str, float | None]]] = defaultdict(list)
+    for record in catalog.iter_records(root):
+        if not record.scanned:
+            continue
+        folder = str(Path(record.path).parent)
+        if record.coordinates:
+            points.append(record.coordinates)
+            point_folders.append(folder)
+            times.append(timestamp(record.taken))
+        else:
+            untagged[folder].append((record.path, timestamp(record.taken)))
+
+    if not untagged:
+        return []
+
+    labels = cluster_points(points, eps_km, min_points)
+
+    folder_points: dict[str, list[tuple[int, Coordinates]]] = defaultdict(list)
+    parent_indexes: dict[str, list[int]] = defaultdict(list)
+    for index, (point, label, folder) in enumerate(zip(points, labels, point_folders)):
+        folder_points[folder].append((label, point))
+        parent_indexes[str(Path(folder).parent)].append(index)
+
+    parent_events = {
+        parent: events(
+            [points[index] for index in indexes],
+            [labels[index] for index in indexes],
+            [times[index] for index in indexes],
+        )
+        for parent, indexes in parent_indexes.items()
+    }
+
+    result = []
+    for folder, photos in untagged.items():
+        if folder in folder_points:
+            items = folder_points[folder]
+            counts = Counter(label for label, _ in items if label >= 0)
+            if counts:
+                label, amount = counts.most_common(1)[0]
+                selected = [point for item, point in items if item == label]
+            else:
+                # too few photos for a place, they have to agree on their own
+                selected = agreeing([point for _, point in items], eps_km)
+                amount = len(selected)
+                if amount < 2 and len(items) > 1:
+                    continue
+            result.append(
+                Suggestion(
+                    folder,
+                    spherical_center(selected),
+                    amount / len(items),
+                    "folder",
+                    [path for path, _ in photos],
+                )
+            )
+            continue
+
+        # untagged folder, match its photos to the events of its siblings
+        matches: dict[Event, list[str]] = defaultdict(list)
+        for path, seconds in photos:
+            if seconds is None:
+                continue
+            for event in parent_events.get(str(Path(folder).parent), []):
+                if event.start - event_margin <= seconds <= event.end + event_margin:
+                    matches[event].append(path)
+                    break
+
+        for event, paths in matches.items():
+            result.append(
+                Suggestion(
+                    folder, event.centroid, len(paths) / len(photos), "event", paths
+                )
+            )
+
+    return result
+
+
+def sidecar_data(
+    suggestions: Iterable[Suggestion], min_confidence: float = 0.0
+) -> list[tuple[str, float, float]]:
+    """
+    Converts the suggestions into the entries expected by create_sidecars,
+    one per untagged photo
+    """
+    return [
+        (path, *suggestion.coordinates)
+        for suggestion in suggestions
+        if suggestion.confidence >= min_confidence
+        for path in suggestion.paths
+    ]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("root", type=Path)
+    parser.add_argument("--eps", type=float, default=default_eps_km, help="km")
+    parser.add_argument("--min-points", type=int, default=default_min_points)
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--scan", action="store_true", help="update the catalog first")
+    parser.add_argument("--apply", action="store_true", help="write the sidecars")
+    parser.add_argument(
+        "--embedded", action="store_true", help="write into the images, not sidecars"
+    )
+    parser.add_argument(
+        "--preserve-mtime", action="store_true", help="keep the images modified time"
+    )
+    args = parser.parse_args(argv)
+
+    catalog = get_catalog()
+    root = args.root.resolve()
+    if args.scan:
+        catalog.scan_tree(root)
+
+    suggestions = suggest_locations(root, catalog, args.eps, args.min_points)
+    for suggestion in suggestions:
+        print(
+            f"{suggestion.folder}\t{suggestion.coordinates.latitude:.6f}\t"
+            f"{suggestion.coordinates.longitude:.6f}\t{suggestion.confidence:.2f}\t"
+            f"{suggestion.source}\t{len(suggestion.paths)} photos"
+        )
+
+    data = sidecar_data(suggestions, args.min_confidence)
+    print(f"{len(data)} photos above confidence {args.min_confidence}")
+    if args.apply:
+        journal = run_job(
+            data, embedded=args.embedded, preserve_mtime=args.preserve_mtime
+        )
+        target = "Images" if args.embedded else "Sidecars"
+        print(f"{target} written, job {journal.id}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
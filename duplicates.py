@@ -0,0 +1,216 @@
+"""
+Detection of copies of the same image across the catalog.
+
+Only images sharing their size can be copies, so those get a quick hash of
+their header and tail, and only those sharing the quick hash too get the full
+hash that confirms them. Fingerprints are kept in the catalog, so each file is
+hashed once until it changes. A location set on one copy is written to all of
+them in a single job.
+
+    python duplicates.py ROOT --scan --apply
+    python duplicates.py FOLDER_OR_IMAGE --tag LATITUDE LONGITUDE
+"""
+
+import argparse
+import sys
+from itertools import groupby
+from pathlib import Path
+from typing import Callable
+
+from catalog import Catalog, commit_size, get_catalog
+from fingerprint import full_hash, is_complete, quick_hash
+from geo import images_extensions
+from journal import Journal, run_job
+
+
+def fingerprint(
+    catalog: Catalog | None = None,
+    sizes: list[int] | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> int:
+    """
+    Computes the missing fingerprints of the images sharing their size, or
+    only of the given sizes. Returns the number of files hashed
+    """
+    catalog = catalog or get_catalog()
+    shared = catalog.shared_sizes()
+    if sizes is not None:
+        shared = sorted(set(shared) & set(sizes))
+
+    done = 0
+    hashes = []
+    for size in shared:
+        if should_stop and should_stop():
+            break
+
+        rows = []
+        for path, quick, full in catalog.fingerprints(size):
+            if not quick:
+                quick = quick_hash(path, size)
+                if not quick:
+                    continue
+                hashes.append((quick, full, path))
+                done += 1
+            rows.append((quick, full, path))
+
+        rows.sort()
+        for _, group in groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            if len(group) < 2:
+                continue
+
+            for quick, full, path in group:
+                if full:
+                    continue
+                # small files are entirely covered by the quick hash
+                full = quick if is_complete(size) else full_hash(path)
+                if full:
+                    hashes.append((quick, full, path))
+                    done += 1
+
+        if len(hashes) >= commit_size:
+            catalog.store_hashes(hashes)
+            hashes = []
+
+    catalog.store_hashes(hashes)
+    return done
+
+
+def copy_locations(catalog: Catalog | None = None) -> list[tuple[str, float, float]]:
+    """
+    Sidecar data giving the untagged copies of each tagged image its location.
+    Copies tagged with different locations are left alone
+    """
+    catalog = catalog or get_catalog()
+    data = []
+    for group in catalog.duplicate_groups():
+        locations = {
+            record.coordinates
+            for record in group
+            if record.scanned and record.coordinates
+        }
+        if len(locations) != 1:
+            continue
+
+        location = locations.pop()
+        data += [
+            (record.path, *location)
+            for record in group
+            if record.scanned and not record.coordinates
+        ]
+
+    return data
+
+
+def with_copies(
+    data: list[tuple[str, float, float]], catalog: Catalog | None = None
+) -> list[tuple[str, float, float]]:
+    """
+    Adds the copies of the files in the sidecar data, and of the images of its
+    folders, with the same location
+    """
+    catalog = catalog or get_catalog()
+    files = []
+    for path, latitude, longitude in data:
+        path = Path(path)
+        if path.is_dir():
+            catalog.sync_folder(path)
+            files += [
+                (str(item), latitude, longitude)
+                for item in sorted(path.iterdir())
+                if item.suffix.lower() in images_extensions and item.is_file()
+            ]
+        elif path.is_file():
+            files.append((str(path), latitude, longitude))
+
+    records = [catalog.record(path) for path, _, _ in files]
+    fingerprint(catalog, [record.size for record in records if record])
+
+    paths = {path for path, _, _ in files}
+    result = list(data)
+    for path, latitude, longitude in files:
+        for copy in catalog.copies(path):
+            if copy.path not in paths:
+                paths.add(copy.path)
+                result.append((copy.path, latitude, longitude))
+
+    return result
+
+
+def tag_with_copies(
+    data: list[tuple[str, float, float]],
+    overwrite: bool = False,
+    catalog: Catalog | None = None,
+    embedded: bool = False,
+    preserve_mtime: bool = False,
+) -> Journal:
+    """
+    Writes the location of the files and of all their copies as one job
+    """
+    return run_job(
+        with_copies(data, catalog),
+        overwrite,
+        embedded=embedded,
+        preserve_mtime=preserve_mtime,
+    )
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("root", type=Path, nargs="?")
+    parser.add_argument("--scan", action="store_true", help="update the catalog first")
+    parser.add_argument(
+        "--apply", action="store_true", help="tag the untagged copies of tagged images"
+    )
+    parser.add_argument(
+        "--tag",
+        type=float,
+        nargs=2,
+        metavar=("LATITUDE", "LONGITUDE"),
+        help="tag ROOT, a folder or an image, and all the copies of its images",
+    )
+    parser.add_argument(
+        "--embedded", action="store_true", help="write into the images, not sidecars"
+    )
+    parser.add_argument(
+        "--preserve-mtime", action="store_true", help="keep the images modified time"
+    )
+    args = parser.parse_args(argv)
+
+    catalog = get_catalog()
+    if args.scan and args.root:
+        catalog.scan_tree(args.root.resolve())
+
+    if args.tag:
+        if not args.root:
+            parser.error("--tag needs ROOT")
+        journal = tag_with_copies(
+            [(str(args.root.resolve()), *args.tag)],
+            catalog=catalog,
+            embedded=args.embedded,
+            preserve_mtime=args.preserve_mtime,
+        )
+        target = "Images" if args.embedded else "Sidecars"
+        print(f"{target} written, job {journal.id}")
+        return 0
+
+    print(f"{fingerprint(catalog)} files hashed")
+    groups = list(catalog.duplicate_groups())
+    for group in groups:
+        print("\n".join(record.path for record in group) + "\n")
+    print(f"{len(groups)} groups of copies")
+
+    data = copy_locations(catalog)
+    print(f"{len(data)} untagged copies of tagged images")
+    if args.apply and data:
+        journal = run_job(
+            data, embedded=args.embedded, preserve_mtime=args.preserve_mtime
+        )
+        target = "Images" if args.embedded else "Sidecars"
+        print(f"{target} written, job {journal.id}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""
+Writing of the GPS coordinates into the originals instead of sidecars.
+
+Either way the GPS directory ends up with the new latitude, longitude and map
+datum only, the other position tags of the prior fix, as its altitude or time,
+being dropped. When the exif of a JPEG or TIFF file already has a GPS
+directory holding just those entries, the new values have the same size and
+are patched over the old ones in place, without parsing or rewriting the rest
+of the file. Otherwise the file is read once, updated through exiv2 in memory
+and written to a temporary file that atomically replaces the original, so an
+interruption never leaves a half written image.
+"""
+
+import os
+import shutil
+import struct
+from pathlib import Path
+from typing import BinaryIO, Callable
+
+from pyexiv2 import ImageData
+
+from geo import GPS
+
+embedded_extensions = [".jpg", ".jpeg", ".tif", ".tiff", ".dng"]
+gps_prefix = "Exif.GPSInfo."
+
+# GPS directory tags patched in place, with their expected type and count
+version, latitude_ref, latitude, longitude_ref, longitude = 0, 1, 2, 3, 4
+map_datum = 18
+patch_tags = {
+    latitude_ref: (2, 2),
+    latitude: (5, 3),
+    longitude_ref: (2, 2),
+    longitude: (5, 3),
+    map_datum: (2, 7),
+}
+tag_names = {
+    latitude_ref: "GPSLatitudeRef",
+    latitude: "GPSLatitude",
+    longitude_ref: "GPSLongitudeRef",
+    longitude: "GPSLongitude",
+    map_datum: "GPSMapDatum",
+}
+# tags kept when the coordinates are replaced, describing the format only
+kept_tags = {gps_prefix + "GPSVersionID"}
+
+
+def _exif_base(file: BinaryIO) -> int | None:
+    """
+    Offset of the tiff structure holding the exif, None when there is none
+    """
+    start = file.read(2)
+    if start in (b"II", b"MM"):
+        return 0
+    if start != b"\xff\xd8":
+        return None
+
+    while True:
+        marker = file.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            return None
+
+        (length,) = struct.unpack(">H", marker[2:])
+        segment = file.tell()
+        if marker[1] == 0xE1 and file.read(6) == b"Exif\x00\x00":
+            return segment + 6
+
+        file.seek(segment + length - 2)
+
+
+def gps_fields(file: BinaryIO) -> tuple[str, dict[int, int]] | None:
+    """
+    Byte order of the exif and the file position of the value of each of the
+    patch_tags in the GPS directory, None when any of them is missing or has an
+    unexpected type or size, or when the directory has other position tags
+    """
+    base = _exif_base(file)
+    if base is None:
+        return None
+
+    file.seek(base)
+    header = file.read(8)
+    if len(header) < 8 or header[:2] not in (b"II", b"MM"):
+        return None
+    order = "<" if header[:2] == b"II" else ">"
+    first = struct.unpack(order + "I", header[4:])[0]
+
+    def entries(offset: int) -> list[tuple[int, int, int, int, int]]:
+        file.seek(base + offset)
+        data = file.read(2)
+        if len(data) < 2:
+            return []
+        (count,) = struct.unpack(order + "H", data)
+        data = file.read(count * 12)
+        return [
+            (
+                *struct.unpack_from(order + "HHII", data, i * 12),
+                base + offset + 2 + i * 12,
+            )
+            for i in range(len(data) // 12)
+        ]
+
+    gps_offset = next(
+        (value for tag, _, _, value, _ in entries(first) if tag == 0x8825), None
+    )
+    if not gps_offset:
+        return None
+
+    positions = {}
+    for tag, kind, count, value, position in entries(gps_offset):
+        if tag == version:
+            continue
+        if patch_tags.get(tag) != (kind, count):
+            return None
+        # values of up to 4 bytes are stored in the entry itself
+        positions[tag] = position + 8 if kind == 2 and count <= 4 else base + value
+
+    if len(positions) != len(patch_tags):
+        return None
+
+    return order, positions
+
+
+def _read_fields(
+    file: BinaryIO, order: str, positions: dict[int, int]
+) -> dict[str, str]:
+    values = {}
+    for tag, position in positions.items():
+        file.seek(position)
+        kind, count = patch_tags[tag]
+        if kind == 2:
+            values[tag_names[tag]] = (
+                file.read(count).rstrip(b"\x00").decode("ascii", "replace")
+            )
+        else:
+            numbers = struct.unpack(order + "6I", file.read(24))
+            values[tag_names[tag]] = " ".join(
+                f"{numbers[i]}/{numbers[i + 1]}" for i in range(0, 6, 2)
+            )
+    return {gps_prefix + name: value for name, value in values.items()}
+
+
+def has_coordinates(gps: dict[str, str] | None) -> bool:
+    """
+    Whether exif GPS tags hold coordinates, as cameras without a fix often
+    write empty or zero ones
+    """
+    if not gps:
+        return False
+
+    reference = gps.get(gps_prefix + "GPSLatitudeRef", "")
+    values = (
+        gps.get(gps_prefix + "GPSLatitude", "")
+        + " "
+        + gps.get(gps_prefix + "GPSLongitude", "")
+    )
+    return reference in ("N", "S") and any(
+        not part.startswith("0/") for part in values.split()
+    )
+
+
+def patch_gps(
+    file: Path,
+    gps: GPS,
+    overwrite: bool,
+    before_write: Callable[[dict[str, str] | None], None] | None = None,
+) -> tuple[str, dict[str, str] | None] | None:
+    """
+    Overwrites the GPS values in place, returning the status and the prior
+    GPS tags, or None when the file has no room for them. before_write gets
+    the prior GPS tags once the file is about to change
+    """
+    with open(file, "r+b") as stream:
+        fields = gps_fields(stream)
+        if not fields:
+            return None
+
+        order, positions = fields
+        prior = _read_fields(stream, order, positions)
+        if has_coordinates(prior) and not overwrite:
+            return "skipped", prior
+
+        if before_write:
+            before_write(prior)
+
+        exif = gps.to_exif()
+        values = {
+            tag: exif[gps_prefix + name] if patch_tags[tag][0] == 2 else None
+            for tag, name in tag_names.items()
+        }
+        values[latitude] = gps.latitude_degrees
+        values[longitude] = gps.longitude_degrees
+        for tag, value in values.items():
+            stream.seek(positions[tag])
+            if isinstance(value, str):
+                count = patch_tags[tag][1]
+                stream.write(value.encode("ascii")[: count - 1].ljust(count, b"\x00"))
+            else:
+                stream.write(
+                    struct.pack(
+                        order + "6I",
+                        *(
+                            number
+                            for part in value[:3]
+                            for number in (part.numerator, part.denominator)
+                        ),
+                    )
+                )
+
+    return "written", prior
+
+
+def rewrite_gps(
+    file: Path,
+    gps: dict[str, str] | None,
+    overwrite: bool,
+    before_write: Callable[[dict[str, str] | None], None] | None = None,
+) -> tuple[str, dict[str, str] | None]:
+    """
+    Replaces the GPS tags of the image with gps, through a single exiv2 open
+    of the file read in memory and an atomic replace. Returns the status and
+    the prior GPS tags, given to before_write once the file is about to change
+    """
+    with ImageData(file.read_bytes()) as image:
+        prior = {
+            key: value
+            for key, value in image.read_exif().items()
+            if key.startswith(gps_prefix)
+        }
+        if has_coordinates(prior) and not overwrite:
+            return "skipped", prior
+
+        # None values delete the tags of the prior position not set again
+        changes = {key: None for key in prior if key not in kept_tags}
+        changes.update(gps or {})
+        image.modify_exif(changes)
+        data = image.get_bytes()
+
+    if before_write:
+        before_write(prior or None)
+
+    temporary = file.with_name(f".{file.name}.{os.getpid()}.tmp")
+    try:
+        with open(temporary, "wb") as stream:
+            stream.write(data)
+            stream.flush()
+            os.fsync(stream.fileno())
+        shutil.copymode(file, temporary)
+        os.replace(temporary, file)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+    return "written", prior or None
+
+
+def write_embedded_gps(
+    file: Path,
+    latitude: float,
+    longitude: float,
+    overwrite: bool,
+    preserve_mtime: bool = False,
+    before_write: Callable[[dict[str, str] | None], None] | None = None,
+) -> tuple[str, dict[str, str] | None]:
+    """
+    Writes the coordinates into the image, returning "written" or "skipped"
+    and the GPS tags it had before, to roll back. before_write gets those
+    tags before the image is changed, to record them
+    """
+    gps = GPS.from_decimal(float(latitude), float(longitude))
+    stat = os.stat(file)
+
+    result = patch_gps(file, gps, overwrite, before_write) or rewrite_gps(
+        file, gps.to_exif(), overwrite, before_write
+    )
+    if preserve_mtime and result[0] == "written":
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    return result
+
+
+def restore_embedded_gps(
+    file: Path, prior: dict[str, str] | None, preserve_mtime: bool = False
+):
+    """
+    Puts back the GPS tags an image had before write_embedded_gps
+    """
+    stat = os.stat(file)
+    rewrite_gps(file, prior, True)
+    if preserve_mtime:
+        os.utime(file, ns=(stat.st_atime_ns, stat.st_mtime_ns))
@@ -0,0 +1,187 @@
+"""
+Streaming export of the photo locations in the catalog.
+
+Records are written one at a time as they are read from the catalog, so the
+memory used does not depend on the size of the library. The format is taken
+from the output extension: .geojson, .kml, .gpx or .csv.
+
+    python export.py ROOT locations.geojson --bbox 36 -10 43 -6 --start 2019-01-01
+"""
+
+import argparse
+import csv
+import json
+import sys
+from pathlib import Path
+from typing import TextIO
+from xml.sax.saxutils import escape
+
+from catalog import Catalog, Filter, Record, get_catalog
+
+buffer_size = 1024 * 1024
+
+
+def iso_time(taken: str | None) -> str | None:
+    return taken.replace(" ", "T") if taken else None
+
+
+class Writer:
+    def __init__(self, file: TextIO):
+        self.file = file
+
+    def begin(self):
+        pass
+
+    def write(self, record: Record):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+
+class GeoJSONWriter(Writer):
+    def begin(self):
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.separator = ""
+
+    def write(self, record: Record):
+        # only the strings go through json, the rest is formatted directly
+        self.file.write(
+            f"{self.separator}"
+            '{"type": "Feature", "geometry": {"type": "Point", "coordinates": '
+            f"[{record.longitude}, {record.latitude}]}}, "
+            f'"properties": {{"path": {json.dumps(record.path)}, '
+            f'"name": {json.dumps(record.name)}, '
+            f'"taken": {json.dumps(iso_time(record.taken))}}}}}'
+        )
+        self.separator = ",\n"
+
+    def end(self):
+        self.file.write("\n]}\n")
+
+
+class KMLWriter(Writer):
+    def begin(self):
+        self.file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+        )
+
+    def write(self, record: Record):
+        taken = iso_time(record.taken)
+        timestamp = f"<TimeStamp><when>{taken}</when></TimeStamp>" if taken else ""
+        self.file.write(
+            f"<Placemark><name>{escape(record.name)}</name>"
+            f"<description>{escape(record.path)}</description>{timestamp}"
+            f"<Point><coordinates>{record.longitude},{record.latitude}</coordinates>"
+            "</Point></Placemark>\n"
+        )
+
+    def end(self):
+        self.file.write("</Document>\n</kml>\n")
+
+
+class GPXWriter(Writer):
+    def begin(self):
+        self.file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="SmartGeoTag" '
+            'xmlns="http://www.topografix.com/GPX/1/1">\n'
+        )
+
+    def write(self, record: Record):
+        taken = iso_time(record.taken)
+        time = f"<time>{taken}</time>" if taken else ""
+        self.file.write(
+            f'<wpt lat="{record.latitude}" lon="{record.longitude}">{time}'
+            f"<name>{escape(record.name)}</name><desc>{escape(record.path)}</desc>"
+            "</wpt>\n"
+        )
+
+    def end(self):
+        self.file.write("</gpx>\n")
+
+
+class CSVWriter(Writer):
+    def begin(self):
+        self.csv = csv.writer(self.file)
+        self.csv.writerow(["path", "name", "latitude", "longitude", "taken"])
+
+    def write(self, record: Record):
+        self.csv.writerow(
+            [record.path, record.name, record.latitude, record.longitude, record.taken]
+        )
+
+
+writers = {
+    ".geojson": GeoJSONWriter,
+    ".json": GeoJSONWriter,
+    ".kml": KMLWriter,
+    ".gpx": GPXWriter,
+    ".csv": CSVWriter,
+}
+
+
+def export_locations(
+    root: Path | str,
+    output: Path | str,
+    filter: Filter = Filter(),
+    recursive: bool = True,
+    catalog: Catalog | None = None,
+) -> int:
+    """
+    Writes the tagged images of root to output, returning how many were
+    exported
+    """
+    output = Path(output)
+    writer_class = writers.get(output.suffix.lower())
+    if not writer_class:
+        raise Exception(f"Unsupported export format {output.suffix}")
+
+    catalog = catalog or get_catalog()
+    count = 0
+    with open(output, "w", encoding="utf-8", newline="", buffering=buffer_size) as file:
+        writer = writer_class(file)
+        writer.begin()
+        for record in catalog.iter_records(
+            root, recursive, filter._replace(tagged=True)
+        ):
+            writer.write(record)
+            count += 1
+        writer.end()
+
+    return count
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("root", type=Path)
+    parser.add_argument("output", type=Path)
+    parser.add_argument(
+        "--bbox", type=float, nargs=4, metavar=("SOUTH", "WEST", "NORTH", "EAST")
+    )
+    parser.add_argument("--start", help="first capture date, 2019-01-31")
+    parser.add_argument("--end", help="last capture date, 2019-01-31")
+    parser.add_argument("--not-recursive", action="store_true")
+    parser.add_argument("--scan", action="store_true", help="update the catalog first")
+    args = parser.parse_args(argv)
+
+    catalog = get_catalog()
+    root = args.root.resolve()
+    if args.scan:
+        catalog.scan_tree(root)
+
+    count = export_locations(
+        root,
+        args.output,
+        Filter(start=args.start, end=args.end, bbox=args.bbox and tuple(args.bbox)),
+        not args.not_recursive,
+        catalog,
+    )
+    print(f"{count} locations exported to {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Content fingerprints of the images, to recognize copies of the same file.
+
+The quick hash covers the size and the first and last sample_size bytes, which
+hold the metadata of the images, so it tells files apart reading little more
+than their header. The full hash reads the whole file and is only computed to
+confirm that files with the same quick hash are copies.
+
+JPEG files keep their metadata in the segments before the image data, which
+usually all fit in the first sample_size bytes. For those, files with the same
+quick hash have the same metadata, whether or not the rest of them differs.
+"""
+
+import hashlib
+import os
+import struct
+from pathlib import Path
+
+sample_size = 64 * 1024
+chunk_size = 1024 * 1024
+
+
+def quick_hash(path: Path | str, size: int | None = None) -> str | None:
+    try:
+        with open(path, "rb") as file:
+            if size is None:
+                size = os.fstat(file.fileno()).st_size
+            digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+            digest.update(file.read(sample_size))
+            if size > 2 * sample_size:
+                file.seek(-sample_size, os.SEEK_END)
+            digest.update(file.read(sample_size))
+            return digest.hexdigest()
+    except OSError as e:
+        print(f"Error hashing {path}: {e}")
+        return None
+
+
+def full_hash(path: Path | str) -> str | None:
+    try:
+        with open(path, "rb") as file:
+            digest = hashlib.blake2b(digest_size=32)
+            while chunk := file.read(chunk_size):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except OSError as e:
+        print(f"Error hashing {path}: {e}")
+        return None
+
+
+def is_complete(size: int) -> bool:
+    """
+    Whether the quick hash of a file of this size already covers all of it
+    """
+    return size <= 2 * sample_size
+
+
+def metadata_sampled(path: Path | str) -> bool:
+    """
+    Whether a JPEG file reaches its image data within the first sample_size
+    bytes, so the quick hash covers all of its metadata. Other formats can
+    keep their metadata anywhere in the file
+    """
+    try:
+        with open(path, "rb") as file:
+            head = file.read(sample_size)
+    except OSError as e:
+        print(f"Error reading {path}: {e}")
+        return False
+
+    if head[:2] != b"\xff\xd8":
+        return False
+
+    position = 2
+    while position + 4 <= len(head):
+        if head[position] != 0xFF:
+            return False
+        marker = head[position + 1]
+        if marker == 0xFF:
+            # fill byte before a marker
+            position += 1
+            continue
+        if marker == 0xDA:
+            return True
+        (length,) = struct.unpack(">H", head[position + 2 : position + 4])
+        position += 2 + length
+
+    return False
@@ -1,23 +1,45 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut
-from geopy.location import Location
-
-
 from pyexiv2 import Image as ImageExiv2
 
-from typing import NamedTuple
+from typing import Callable, NamedTuple, TYPE_CHECKING
 from enum import Enum
 from dataclasses import dataclass
 from time import sleep
+from datetime import datetime
 import fractions
 from functools import lru_cache
 
+import instrumentation
+from instrumentation import instrument
+from siblings import group_siblings
+
 batch = []
 batch_size = 950
+# processes writing sidecars or embedded coordinates, and the least amount of
+# files worth starting them for
+workers = max(1, min(8, (os.cpu_count() or 1) - 1))
+parallel_threshold = 200
+# files per task of the worker processes, each running one task at a time, so
+# progress is reported often and a stop takes effect quickly
+chunk_size = 50
 min_size = 1024 * 1024
 
+if TYPE_CHECKING:
+    from geopy.location import Location
+    from journal import Journal
+
+capture_time_tags = [
+    "Exif.Photo.DateTimeOriginal",
+    "Exif.Image.DateTime",
+    "Xmp.exif.DateTimeOriginal",
+    "Xmp.xmp.CreateDate",
+]
+
 images_extensions = [
     ".jpeg",
     ".jpg",
@@ -137,6 +159,10 @@ def folders(path: Path) -> list[str]:
 
 
 def get_coordinates(location: str) -> Coordinates | None:
+    # geopy is only needed once the user searches for a location
+    from geopy.geocoders import Nominatim
+    from geopy.exc import GeocoderTimedOut
+
     geolocator = Nominatim(user_agent="geo")
     count = 1
     while count < 5:
@@ -148,6 +174,7 @@ def get_coordinates(location: str) -> Coordinates | None:
                     gps_location.longitude,
                 )
         except GeocoderTimedOut as e:
+            instrumentation.count("nominatim_retries")
             sleep(1)
             count += 1
         except Exception as e:
@@ -157,12 +184,16 @@ def get_coordinates(location: str) -> Coordinates | None:
     print(f"Unable to get gps coordinates for {location}!")
 
 
+@instrument()
 def get_suggestions(location: str) -> list[tuple[str, Coordinates]]:
+    from geopy.geocoders import Nominatim
+    from geopy.exc import GeocoderTimedOut
+
     geolocator = Nominatim(user_agent="geo")
     count = 1
     while count < 5:
         try:
-            gps_locations: list[Location] = geolocator.geocode(
+            gps_locations: list["Location"] = geolocator.geocode(
                 location, exactly_one=False, limit=5, timeout=5
             )
             return [
@@ -170,6 +201,7 @@ def get_suggestions(location: str) -> list[tuple[str, Coordinates]]:
                 for location in gps_locations
             ]
         except GeocoderTimedOut as e:
+            instrumentation.count("nominatim_retries")
             sleep(1)
             count += 1
         except Exception as e:
@@ -194,32 +226,115 @@ def valid_gps_tags(tags: dict[str:str]) -> bool:
     )
 
 
-def get_gps_data(file: Path) -> Coordinates | None:
+@instrument()
+def read_metadata(file: Path) -> tuple[dict | None, str | None]:
+    """
+    Reads the GPS tags and the capture time from the exif / xmp data of a file
+    with a single open
+    """
+    gps_result, date_time = None, None
     try:
         with ImageExiv2(str(file)) as img:
             for data in [img.read_exif(), img.read_xmp()]:
-                gps_info = {}
-                for key, value in data.items():
-                    if "GPSInfo" in key:
-                        gps_info[key[13:]] = value
-                    if "datetime" not in gps_info and "Exif.Image.DateTime" in data:
-                        gps_info["datetime"] = data["Exif.Image.DateTime"]
-                if valid_gps_tags(gps_info):
-                    return gps_info
+                if not date_time:
+                    date_time = next(
+                        (data[tag] for tag in capture_time_tags if tag in data), None
+                    )
+                if gps_result is None:
+                    gps_info = {}
+                    for key, value in data.items():
+                        if "GPSInfo" in key:
+                            gps_info[key[13:]] = value
+                    if valid_gps_tags(gps_info):
+                        gps_result = gps_info
     except Exception as e:
         print(f"Error reading exif information from file {file}: {e}")
 
+    if gps_result is not None and date_time:
+        gps_result["datetime"] = date_time
+
+    return gps_result, date_time
+
+
+@instrument()
+def get_gps_data(file: Path) -> dict | None:
+    return read_metadata(file)[0]
+
 
+@instrument()
 @lru_cache(maxsize=2048)
-def get_image_gps(file: Path) -> Coordinates | None:
+def get_image_gps(file: Path) -> dict | None:
     sidecar = file.with_suffix(f"{file.suffix}.xmp")
     if sidecar.exists():
-        if result := get_gps_data(file):
+        if result := get_gps_data(sidecar):
             return result
 
     return get_gps_data(file)
 
 
+def get_image_metadata(
+    file: Path, shared: tuple[dict | None, str | None] | None = None
+) -> tuple[Coordinates | None, str | None]:
+    """
+    Coordinates and capture time of an image, the sidecar taking precedence
+    over the image itself. shared is the read_metadata result of a sibling of
+    the same capture, used instead of reading the image
+    """
+    gps_info, date_time = None, None
+    sidecar = file.with_suffix(f"{file.suffix}.xmp")
+    if sidecar.exists():
+        gps_info, date_time = read_metadata(sidecar)
+
+    if gps_info is None or not date_time:
+        image_gps, image_date_time = shared if shared else read_metadata(file)
+        gps_info = gps_info or image_gps
+        date_time = date_time or image_date_time
+
+    return gps_coordinates(gps_info), normalize_capture_time(date_time)
+
+
+def gps_coordinates(gps_info: dict | None) -> Coordinates | None:
+    if not gps_info:
+        return None
+
+    try:
+        return GPS.from_exif(
+            gps_info["GPSLatitude"],
+            gps_info["GPSLatitudeRef"],
+            gps_info["GPSLongitude"],
+            gps_info["GPSLongitudeRef"],
+        ).coordinates
+    except Exception as e:
+        print(f"Error converting gps information {gps_info}: {e}")
+        return None
+
+
+def parse_capture_time(value: str | None) -> datetime | None:
+    """
+    Parses exif ( 2019:01:31 10:00:00 ) and xmp ( 2019-01-31T10:00:00+01:00 )
+    date times, ignoring sub seconds and time zones
+    """
+    if not value:
+        return None
+
+    value = value.strip().replace("T", " ")
+    try:
+        return datetime.strptime(value[:19].replace("-", ":"), "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        try:
+            return datetime.strptime(value[:10].replace("-", ":"), "%Y:%m:%d")
+        except ValueError:
+            return None
+
+
+def normalize_capture_time(value: str | None) -> str | None:
+    """
+    Capture time as a sortable iso string ( 2019-01-31 10:00:00 )
+    """
+    taken = parse_capture_time(value)
+    return taken.isoformat(sep=" ") if taken else None
+
+
 def convert_string_degree(value: str) -> Fraction | None:
     try:
         if "/" in value:
@@ -280,6 +395,7 @@ def decimal_to_degrees(
     return Degrees(Fraction(deg), Fraction(min), Fraction(sec), quad)
 
 
+@instrument()
 def write_gps_sidecar(file: Path, latitude: float, longitude: float, overwrite: bool):
     if not file.is_file() or file.suffix.lower() not in images_extensions:
         return
@@ -339,7 +455,146 @@ def process_dir(dir: Path) -> list[list[str, str, str, str]]:
         print("Error on folder {}: {}".format(dir, error))
 
 
-def create_sidecars(data: list[tuple[str, float, float]], overwrite: bool = False):
+def write_group_sidecars(
+    files: list[Path],
+    latitude: float,
+    longitude: float,
+    overwrite: bool,
+):
+    """
+    Writes the sidecars of the files of one capture. The first new sidecar is
+    created through exiv2 and copied to the siblings that have none, existing
+    sidecars are updated in place to keep their other metadata
+    """
+    template = None
+    for file in files:
+        sidecar = file.with_suffix(f"{file.suffix}.xmp")
+        if not file.is_file() or file.suffix.lower() not in images_extensions:
+            continue
+
+        new_sidecar = not sidecar.exists()
+        if not overwrite and not new_sidecar:
+            continue
+
+        if template is not None and new_sidecar:
+            sidecar.write_bytes(template)
+        else:
+            write_gps_sidecar(file, latitude, longitude, overwrite)
+            if new_sidecar and sidecar.exists():
+                template = sidecar.read_bytes()
+
+
+def write_chunk(
+    chunk: list[tuple[list[str], float, float]],
+    overwrite: bool,
+    embedded: bool = False,
+    preserve_mtime: bool = False,
+    priors_log: str | None = None,
+) -> list[tuple[str, float, float, str, dict | None]]:
+    """
+    Writes the coordinates of groups of siblings, to their sidecars or into
+    the images with embedded, in a worker process. Returns ( path, latitude,
+    longitude, status, prior GPS tags ) of each file. The prior GPS tags of
+    each image are also appended to a priors_log file of the process before
+    the image is changed, so they are kept if the process dies
+    """
+    log = None
+    if embedded and priors_log:
+        log = open(f"{priors_log}.{os.getpid()}.priors", "a", encoding="utf-8")
+
+    def recorder(file: str) -> Callable[[dict | None], None] | None:
+        if not log:
+            return None
+
+        def record(prior: dict | None):
+            log.write(json.dumps({"file": file, "prior": prior}) + "\n")
+            log.flush()
+
+        return record
+
+    results = []
+    try:
+        for files, latitude, longitude in chunk:
+            if not embedded:
+                write_group_sidecars(
+                    [Path(file) for file in files], latitude, longitude, overwrite
+                )
+                results += [
+                    (file, latitude, longitude, "written", None) for file in files
+                ]
+                continue
+
+            from embedded import write_embedded_gps
+
+            for file in files:
+                try:
+                    status, prior = write_embedded_gps(
+                        Path(file),
+                        latitude,
+                        longitude,
+                        overwrite,
+                        preserve_mtime,
+                        recorder(file),
+                    )
+                except Exception as e:
+                    print(f"Error writing GPS data into {file}: {e}")
+                    status, prior = "failed", None
+                results.append((file, latitude, longitude, status, prior))
+    finally:
+        if log:
+            log.close()
+
+    return results
+
+
+def _pending_files(
+    files: list[Path], overwrite: bool, journal: "Journal | None", embedded: bool
+) -> list[str]:
+    """
+    Files of a group that still need to be written
+    """
+    if embedded:
+        from embedded import embedded_extensions
+
+    result = []
+    for file in files:
+        target = file if embedded else file.with_suffix(f"{file.suffix}.xmp")
+        if journal and journal.is_committed(target):
+            continue
+        if not file.is_file():
+            continue
+        if embedded:
+            if file.suffix.lower() not in embedded_extensions:
+                continue
+        elif file.suffix.lower() not in images_extensions or (
+            not overwrite and target.exists()
+        ):
+            continue
+        result.append(str(file))
+
+    return result
+
+
+def create_sidecars(
+    data: list[tuple[str, float, float]],
+    overwrite: bool = False,
+    journal: "Journal | None" = None,
+    embedded: bool = False,
+    preserve_mtime: bool = False,
+    progress: Callable[[int, list[tuple[str, str]]], None] | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> bool:
+    """
+    Writes the coordinates of each file, or of the images of each folder, to
+    their sidecars, or with embedded into the images themselves. The groups of
+    siblings are split in chunks of about chunk_size files, submitted to a pool
+    of worker processes as it needs more work when there are at least
+    parallel_threshold files. should_stop is checked before each submission,
+    and the chunks already submitted are still written. progress receives the
+    total of files and the ( path, status ) of the ones just written. Returns
+    False when should_stop interrupted the writes
+    """
+    groups = []
     for path, latitude, longitude in data:
         path = Path(path)
         if not path.exists():
@@ -347,7 +602,82 @@ def create_sidecars(data: list[tuple[str, float, float]], overwrite: bool = Fals
             continue
         if path.is_dir():
             print(f"Processing folder {path}...")
-            for item in path.iterdir():
-                write_gps_sidecar(item, latitude, longitude, overwrite)
+            images = [
+                item
+                for item in path.iterdir()
+                if item.suffix.lower() in images_extensions
+            ]
         else:
-            write_gps_sidecar(path, latitude, longitude, overwrite)
+            images = [path]
+
+        for group in group_siblings(images) if len(images) > 1 else [images]:
+            files = _pending_files(group, overwrite, journal, embedded)
+            if files:
+                groups.append((files, latitude, longitude))
+
+    total = sum(len(files) for files, _, _ in groups)
+
+    def begin(chunk: list[tuple[list[str], float, float]]):
+        # sidecars are journaled before they are touched, embedded writes
+        # once done, as they are atomic
+        if journal and not embedded:
+            for files, latitude, longitude in chunk:
+                for file in files:
+                    journal.begin(Path(f"{file}.xmp"), latitude, longitude)
+
+    def finish(results: list[tuple[str, float, float, str, dict | None]]):
+        if journal:
+            for file, latitude, longitude, status, prior in results:
+                if not embedded:
+                    journal.commit(Path(f"{file}.xmp"))
+                elif status == "written":
+                    journal.embed(Path(file), prior, latitude, longitude)
+        if progress:
+            progress(total, [(result[0], result[3]) for result in results])
+
+    stopped = False
+    priors_log = str(journal.path.with_suffix("")) if journal else None
+    arguments = (overwrite, embedded, preserve_mtime, priors_log)
+    if total < parallel_threshold or workers == 1:
+        # one group at a time, to report progress and stop between them
+        for group in groups:
+            if should_stop and should_stop():
+                stopped = True
+                break
+            begin([group])
+            finish(write_chunk([group], *arguments))
+    else:
+        chunks, chunk, count = [], [], 0
+        for group in groups:
+            chunk.append(group)
+            count += len(group[0])
+            if count >= chunk_size:
+                chunks.append(chunk)
+                chunk, count = [], 0
+        if chunk:
+            chunks.append(chunk)
+
+        pending = iter(chunks)
+        # spawned, as forking a process running Qt threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            running = set()
+            while True:
+                while not stopped and len(running) < workers:
+                    chunk = next(pending, None)
+                    if chunk is None:
+                        break
+                    if should_stop and should_stop():
+                        stopped = True
+                        break
+                    begin(chunk)
+                    running.add(pool.submit(write_chunk, chunk, *arguments))
+
+                if not running:
+                    break
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(future.result())
+
+    get_image_gps.cache_clear()
+    return not stopped
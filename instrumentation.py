@@ -0,0 +1,257 @@
+"""
+Lightweight instrumentation of the hot paths.
+
+Disabled by default, an instrumented function then only pays for one global
+check. Set SMARTGEOTAG_TRACE to a file path to enable it at startup and export
+the data on exit: a .json path produces a Chrome trace (chrome://tracing or
+Perfetto), any other a Prometheus text file.
+"""
+
+import atexit
+import functools
+import json
+import os
+import threading
+from collections import deque
+from pathlib import Path
+from time import perf_counter_ns
+from typing import Callable
+
+# upper bounds in seconds of the latency histogram buckets
+buckets = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, float("inf")]
+max_trace_events = 200000
+
+trace_target = os.environ.get("SMARTGEOTAG_TRACE", "")
+enabled = bool(trace_target)
+
+_lock = threading.Lock()
+_origin = perf_counter_ns()
+_calls: dict[str, list[int]] = {}
+_histograms: dict[str, list[int]] = {}
+_counters: dict[str, int] = {}
+_caches: dict[str, Callable] = {}
+_events: deque = deque(maxlen=max_trace_events)
+
+
+class Stats:
+    def __init__(self, name: str, calls: int, total_ns: int, histogram: list[int]):
+        self.name = name
+        self.calls = calls
+        self.total_ns = total_ns
+        self.histogram = histogram
+
+    @property
+    def mean_ms(self) -> float:
+        return self.total_ns / self.calls / 1e6 if self.calls else 0
+
+    def percentile_ms(self, percentile: float) -> float:
+        """
+        Approximates the percentile by the upper bound of its histogram bucket
+        """
+        target = self.calls * percentile
+        accumulated = 0
+        for bound, amount in zip(buckets, self.histogram):
+            accumulated += amount
+            if accumulated >= target:
+                return bound * 1000
+        return float("inf")
+
+
+def enable(value: bool = True):
+    global enabled
+    enabled = value
+
+
+def reset():
+    with _lock:
+        _calls.clear()
+        _histograms.clear()
+        _counters.clear()
+        _events.clear()
+
+
+def _record(name: str, begin: int, end: int):
+    duration = end - begin
+    seconds = duration / 1e9
+    with _lock:
+        calls = _calls.setdefault(name, [0, 0])
+        calls[0] += 1
+        calls[1] += duration
+
+        histogram = _histograms.setdefault(name, [0] * len(buckets))
+        for i, bound in enumerate(buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+
+        _events.append((name, begin, duration, threading.get_ident()))
+
+
+def instrument(name: str | None = None) -> Callable:
+    """
+    Decorator recording the call count and latency of a function. Functions
+    cached with functools.lru_cache keep cache_info / cache_clear and have their
+    hit rate reported
+    """
+
+    def decorator(func: Callable) -> Callable:
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+
+            begin = perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _record(label, begin, perf_counter_ns())
+
+        if hasattr(func, "cache_info"):
+            wrapper.cache_info = func.cache_info
+            wrapper.cache_clear = func.cache_clear
+            _caches[label] = func.cache_info
+
+        return wrapper
+
+    return decorator
+
+
+def count(name: str, amount: int = 1):
+    if not enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def cache_access(name: str, hit: bool):
+    """
+    Records a hit or miss on caches not based on functools.lru_cache
+    """
+    count(f"{name}_{'hits' if hit else 'misses'}")
+
+
+def stats() -> list[Stats]:
+    with _lock:
+        return [
+            Stats(name, calls, total, list(_histograms[name]))
+            for name, (calls, total) in sorted(_calls.items())
+        ]
+
+
+def counters() -> dict[str, int]:
+    with _lock:
+        return dict(_counters)
+
+
+def cache_hit_rates() -> dict[str, float]:
+    result = {}
+    for name, cache_info in _caches.items():
+        info = cache_info()
+        if info.hits + info.misses:
+            result[name] = info.hits / (info.hits + info.misses)
+
+    values = counters()
+    for key, hits in values.items():
+        if key.endswith("_hits"):
+            misses = values.get(f"{key[:-5]}_misses", 0)
+            result[key[:-5]] = hits / (hits + misses)
+
+    return result
+
+
+def summary() -> str:
+    lines = [
+        f"{'function':<32}{'calls':>10}{'mean ms':>12}{'p50 ms':>10}{'p95 ms':>10}"
+    ]
+    for item in stats():
+        lines.append(
+            f"{item.name:<32}{item.calls:>10}{item.mean_ms:>12.3f}"
+            f"{item.percentile_ms(0.5):>10g}{item.percentile_ms(0.95):>10g}"
+        )
+
+    lines.append("")
+    for name, value in sorted(counters().items()):
+        lines.append(f"{name:<32}{value:>10}")
+
+    for name, rate in sorted(cache_hit_rates().items()):
+        lines.append(f"{name + ' hit rate':<32}{rate:>10.1%}")
+
+    return "\n".join(lines)
+
+
+def chrome_trace() -> dict:
+    pid = os.getpid()
+    with _lock:
+        events = list(_events)
+
+    return {
+        "traceEvents": [
+            {
+                "name": name,
+                "ph": "X",
+                "ts": (begin - _origin) / 1000,
+                "dur": duration / 1000,
+                "pid": pid,
+                "tid": thread,
+            }
+            for name, begin, duration, thread in events
+        ],
+        "displayTimeUnit": "ms",
+    }
+
+
+def prometheus_text() -> str:
+    items = stats()
+
+    lines = ["# TYPE smartgeotag_calls_total counter"]
+    for item in items:
+        lines.append(f'smartgeotag_calls_total{{function="{item.name}"}} {item.calls}')
+
+    lines.append("# TYPE smartgeotag_latency_seconds histogram")
+    for item in items:
+        label = f'function="{item.name}"'
+        accumulated = 0
+        for bound, amount in zip(buckets, item.histogram):
+            accumulated += amount
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            lines.append(
+                f'smartgeotag_latency_seconds_bucket{{{label},le="{le}"}} {accumulated}'
+            )
+        lines.append(
+            f"smartgeotag_latency_seconds_sum{{{label}}} {item.total_ns / 1e9}"
+        )
+        lines.append(f"smartgeotag_latency_seconds_count{{{label}}} {item.calls}")
+
+    lines.append("# TYPE smartgeotag_events_total counter")
+    for name, value in sorted(counters().items()):
+        lines.append(f'smartgeotag_events_total{{name="{name}"}} {value}')
+
+    lines.append("# TYPE smartgeotag_cache_hit_ratio gauge")
+    for name, rate in sorted(cache_hit_rates().items()):
+        lines.append(f'smartgeotag_cache_hit_ratio{{cache="{name}"}} {rate}')
+
+    return "\n".join(lines) + "\n"
+
+
+def export(path: Path | str):
+    """
+    Writes the collected data as a Chrome trace for .json paths, or in the
+    Prometheus text format otherwise
+    """
+    path = Path(path)
+    if path.suffix.lower() == ".json":
+        path.write_text(json.dumps(chrome_trace()))
+    else:
+        path.write_text(prometheus_text())
+
+
+@atexit.register
+def _export_on_exit():
+    if trace_target:
+        try:
+            export(trace_target)
+        except Exception as e:
+            print(f"Error exporting instrumentation data to {trace_target}: {e}")
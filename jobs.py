@@ -0,0 +1,202 @@
+"""
+Background queue of tagging jobs.
+
+Locations applied from the dialogs are written as journaled jobs by a pool of
+max_jobs threads, so several folders can be tagged while the user keeps
+browsing. Each job reports the status of its files as they are written and
+can be cancelled once the few files under way are written, which leaves its
+journal to be resumed or rolled back with journal.py. Once done, the folders
+it wrote to are read again into the catalog.
+"""
+
+import os
+import threading
+
+from PySide6 import QtCore
+from __feature__ import snake_case, true_property
+
+from catalog import Catalog, get_catalog
+from duplicates import with_copies
+from journal import run_job
+
+max_jobs = 2
+
+
+class JobSignals(QtCore.QObject):
+    submitted = QtCore.Signal(int)
+    started = QtCore.Signal(int)
+    progress = QtCore.Signal(int, int, int)
+    file_status = QtCore.Signal(int, str, str)
+    finished = QtCore.Signal(int)
+    folder_updated = QtCore.Signal(str)
+
+
+class TagJob(QtCore.QRunnable):
+    """
+    Writes the coordinates of a list of files or folders as a journaled job in
+    a pool thread, with copies to the copies of their images elsewhere, then
+    updates the catalog with the images it wrote
+    """
+
+    def __init__(
+        self,
+        number: int,
+        title: str,
+        data: list[tuple[str, float, float]],
+        signals: JobSignals,
+        catalog: Catalog,
+        overwrite: bool = False,
+        embedded: bool = False,
+        preserve_mtime: bool = False,
+        copies: bool = False,
+    ):
+        super().__init__()
+        self.number = number
+        self.title = title
+        self.data = data
+        self.signals = signals
+        self.catalog = catalog
+        self.overwrite = overwrite
+        self.embedded = embedded
+        self.preserve_mtime = preserve_mtime
+        self.copies = copies
+
+        self.state = "queued"
+        self.done = 0
+        self.total = 0
+        self.journal_id: str | None = None
+        self.written: list[str] = []
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def progress(self, total: int, results: list[tuple[str, str]]):
+        self.total = total
+        self.done += len(results)
+        for path, status in results:
+            if status == "written":
+                self.written.append(path)
+            self.signals.file_status.emit(self.number, path, status)
+        self.signals.progress.emit(self.number, self.done, self.total)
+
+    def run(self):
+        if self.cancelled.is_set():
+            self.state = "cancelled"
+            self.signals.finished.emit(self.number)
+            return
+
+        self.state = "running"
+        self.signals.started.emit(self.number)
+        try:
+            data = with_copies(self.data, self.catalog) if self.copies else self.data
+            journal = run_job(
+                data,
+                self.overwrite,
+                embedded=self.embedded,
+                preserve_mtime=self.preserve_mtime,
+                progress=self.progress,
+                should_stop=self.cancelled.is_set,
+            )
+            self.journal_id = journal.id
+            self.state = "done" if journal.finished else "cancelled"
+        except Exception as e:
+            print(f"Error running tagging job {self.title}: {e}")
+            self.state = "failed"
+
+        self.update_catalog()
+        self.signals.finished.emit(self.number)
+
+    def update_catalog(self):
+        """
+        Reads the written images again, including those whose size and
+        modified time were kept, and notifies each updated folder
+        """
+        if not self.written:
+            return
+
+        # the catalog keeps the folders as the gui listed them, which the
+        # written paths may spell differently
+        folders = {}
+        for path, _, _ in self.data:
+            folder = path if os.path.isdir(path) else os.path.dirname(path)
+            folders[os.path.normcase(os.path.normpath(folder))] = folder
+
+        updated = {}
+        for path in self.written:
+            key = os.path.normcase(os.path.normpath(os.path.dirname(path)))
+            folder = folders.get(key, os.path.dirname(path))
+            updated.setdefault(folder, []).append(
+                os.path.join(folder, os.path.basename(path))
+            )
+
+        try:
+            for folder, paths in updated.items():
+                self.catalog.invalidate(paths)
+                self.catalog.scan_folder(folder)
+                self.signals.folder_updated.emit(folder)
+        except Exception as e:
+            print(f"Error updating the catalog after job {self.title}: {e}")
+
+
+class JobQueue(QtCore.QObject):
+    """
+    Runs the submitted tagging jobs in the background, up to max_jobs at a
+    time, and keeps them listed with their state and progress. Jobs still
+    running when the application quits are cancelled, their journals left to
+    be resumed
+    """
+
+    def __init__(
+        self, catalog: Catalog | None = None, parent: QtCore.QObject | None = None
+    ):
+        super().__init__(parent)
+        self.catalog = catalog or get_catalog()
+        self.jobs: dict[int, TagJob] = {}
+        self.signals = JobSignals()
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.max_thread_count = max_jobs
+
+        app = QtCore.QCoreApplication.instance()
+        if app:
+            app.aboutToQuit.connect(self.shutdown)
+
+    def submit(
+        self,
+        title: str,
+        data: list[tuple[str, float, float]],
+        overwrite: bool = False,
+        embedded: bool = False,
+        preserve_mtime: bool = False,
+        copies: bool = False,
+    ) -> TagJob:
+        job = TagJob(
+            len(self.jobs) + 1,
+            title,
+            data,
+            self.signals,
+            self.catalog,
+            overwrite,
+            embedded,
+            preserve_mtime,
+            copies,
+        )
+        job.set_auto_delete(False)
+        self.jobs[job.number] = job
+        self.signals.submitted.emit(job.number)
+        self.pool.start(job)
+        return job
+
+    def cancel(self, number: int):
+        job = self.jobs.get(number)
+        if job:
+            job.cancel()
+
+    def active(self) -> list[TagJob]:
+        return [job for job in self.jobs.values() if job.state in ("queued", "running")]
+
+    @QtCore.Slot()
+    def shutdown(self):
+        for job in self.jobs.values():
+            job.cancel()
+        self.pool.wait_for_done()
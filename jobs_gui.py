@@ -0,0 +1,102 @@
+from PySide6 import QtCore, QtWidgets, QtGui
+from __feature__ import snake_case, true_property
+from pathlib import Path
+from jobs import JobQueue
+
+# lines of file statuses kept in the log
+max_log_lines = 2000
+
+
+class JobsWidget(QtWidgets.QWidget):
+    """
+    Lists the tagging jobs with their progress, the status of each file as it
+    is written, and cancels the selected jobs
+    """
+
+    def __init__(self, queue: JobQueue, parent: QtWidgets.QWidget | None = None):
+        super().__init__(parent)
+
+        self.queue = queue
+        self.items: dict[int, QtWidgets.QTreeWidgetItem] = {}
+        self.bars: dict[int, QtWidgets.QProgressBar] = {}
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.contents_margins = QtCore.QMargins(0, 0, 0, 0)
+
+        self.tree_jobs = QtWidgets.QTreeWidget()
+        self.tree_jobs.set_header_labels(["Job", "State", "Progress"])
+        self.tree_jobs.root_is_decorated = False
+        self.tree_jobs.selection_mode = (
+            QtWidgets.QAbstractItemView.SelectionMode.ExtendedSelection
+        )
+        layout.add_widget(self.tree_jobs)
+
+        self.txt_log = QtWidgets.QPlainTextEdit()
+        self.txt_log.read_only = True
+        self.txt_log.maximum_block_count = max_log_lines
+        self.txt_log.font = QtGui.QFontDatabase.system_font(
+            QtGui.QFontDatabase.SystemFont.FixedFont
+        )
+        layout.add_widget(self.txt_log)
+
+        btn_cancel = QtWidgets.QPushButton("Cancel selected jobs")
+        btn_cancel.clicked.connect(self.cancel_selected)
+        layout.add_widget(btn_cancel)
+
+        self.set_layout(layout)
+
+        queue.signals.submitted.connect(self.add_job)
+        queue.signals.started.connect(self.update_job)
+        queue.signals.progress.connect(self.update_progress)
+        queue.signals.file_status.connect(self.log_file)
+        queue.signals.finished.connect(self.update_job)
+
+    @QtCore.Slot(int)
+    def add_job(self, number: int):
+        job = self.queue.jobs[number]
+        item = QtWidgets.QTreeWidgetItem([job.title, job.state, ""])
+        item.set_data(0, QtCore.Qt.ItemDataRole.UserRole, number)
+        self.tree_jobs.add_top_level_item(item)
+        self.items[number] = item
+
+        bar = QtWidgets.QProgressBar()
+        bar.maximum = 0
+        self.tree_jobs.set_item_widget(item, 2, bar)
+        self.bars[number] = bar
+        self.tree_jobs.resize_column_to_contents(0)
+
+    @QtCore.Slot(int)
+    def update_job(self, number: int):
+        job = self.queue.jobs[number]
+        item = self.items.get(number)
+        if item is None:
+            return
+
+        state = job.state
+        if job.journal_id and job.state != "done":
+            state = f"{job.state}, journal {job.journal_id}"
+        item.set_text(1, state)
+
+        if job.state not in ("queued", "running"):
+            bar = self.bars[number]
+            bar.maximum = max(job.total, 1)
+            bar.value = job.done if job.total else bar.maximum
+            self.txt_log.append_plain_text(
+                f"{job.title}: {job.state}, {len(job.written)} of {job.total} written"
+            )
+
+    @QtCore.Slot(int, int, int)
+    def update_progress(self, number: int, done: int, total: int):
+        bar = self.bars.get(number)
+        if bar:
+            bar.maximum = total
+            bar.value = done
+
+    @QtCore.Slot(int, str, str)
+    def log_file(self, number: int, path: str, status: str):
+        self.txt_log.append_plain_text(f"{status:8} {Path(path).name}")
+
+    @QtCore.Slot()
+    def cancel_selected(self):
+        for item in self.tree_jobs.selected_items():
+            self.queue.cancel(item.data(0, QtCore.Qt.ItemDataRole.UserRole))
@@ -0,0 +1,413 @@
+"""
+Journal of bulk tagging jobs.
+
+Every job appends to its own json lines file: a header with the job data,
+then for each sidecar a "write" entry with its prior content, recorded before
+it is touched, and a "commit" entry once written. An interrupted job resumes
+by skipping the committed sidecars without looking at them, after restoring
+the ones left half written, and a job can be rolled back by restoring every
+prior sidecar without going through exiv2. Jobs writing into the images record
+an "embed" entry with the prior GPS tags once each atomic write is done, the
+worker processes logging them beforehand in JOB.PID.priors files next to it.
+The logs are copied into the journal as "prior" entries once the job is done,
+and deleted then or once it is rolled back.
+
+    python journal.py list
+    python journal.py resume JOB
+    python journal.py rollback JOB
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import uuid
+from datetime import datetime
+from pathlib import Path
+from time import time
+from typing import Callable
+
+from geo import create_sidecars, get_image_gps
+
+jobs_path = Path(
+    os.environ.get("SMARTGEOTAG_JOBS", Path.home() / ".smartgeotag" / "jobs")
+)
+
+# entries are flushed as they are written, and synced to disk every
+# sync_interval commits
+sync_interval = 100
+
+
+class Journal:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.id = self.path.stem
+        self.data: list[tuple[str, float, float]] = []
+        self.overwrite = False
+        self.embedded = False
+        self.preserve_mtime = False
+        self.created = 0.0
+        self.committed: set[str] = set()
+        # sidecars whose prior content is recorded, the content itself is only
+        # read back from the file to restore them
+        self.begun: set[str] = set()
+        self.finished = False
+        self.rolled_back = False
+        self._file = None
+        self._pending = 0
+
+    @classmethod
+    def create(
+        cls,
+        data: list[tuple[str, float, float]],
+        overwrite: bool = False,
+        directory: Path = jobs_path,
+        embedded: bool = False,
+        preserve_mtime: bool = False,
+    ) -> "Journal":
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.jsonl"
+        journal = cls(directory / name)
+        journal.data = [
+            (str(path), latitude, longitude) for path, latitude, longitude in data
+        ]
+        journal.overwrite = overwrite
+        journal.embedded = embedded
+        journal.preserve_mtime = preserve_mtime
+        journal.created = time()
+        journal._append(
+            {
+                "type": "job",
+                "created": journal.created,
+                "overwrite": overwrite,
+                "embedded": embedded,
+                "preserve_mtime": preserve_mtime,
+                "data": journal.data,
+            },
+            sync=True,
+        )
+        return journal
+
+    @classmethod
+    def open(cls, path: Path | str) -> "Journal":
+        """
+        Loads a journal from its file, ignoring a last line cut by an
+        interruption
+        """
+        journal = cls(Path(path))
+        with open(journal.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+                kind = entry["type"]
+                if kind == "job":
+                    journal.data = [tuple(item) for item in entry["data"]]
+                    journal.overwrite = entry["overwrite"]
+                    journal.embedded = entry.get("embedded", False)
+                    journal.preserve_mtime = entry.get("preserve_mtime", False)
+                    journal.created = entry["created"]
+                elif kind == "write":
+                    journal.begun.add(entry["sidecar"])
+                elif kind == "commit":
+                    journal.committed.add(entry["sidecar"])
+                elif kind == "embed":
+                    journal.committed.add(entry["file"])
+                elif kind == "done":
+                    journal.finished = True
+                elif kind == "rollback":
+                    journal.rolled_back = True
+
+        return journal
+
+    def priors(self) -> tuple[dict[str, str | None], dict[str, dict | None]]:
+        """
+        Reads back from the file the content of each sidecar before the job
+        first touched it, None when it did not exist, and the GPS tags of each
+        image written by an embedded job before the job, in the job order
+        """
+        if self._file:
+            self._file.flush()
+
+        sidecars, logged, embedded = {}, self._logged_priors(), {}
+        with open(self.path, encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+
+                # only the first entry of a file holds its prior content
+                if entry["type"] == "write" and "prior" in entry:
+                    sidecars.setdefault(entry["sidecar"], entry["prior"])
+                elif entry["type"] == "prior":
+                    logged.setdefault(entry["file"], entry["prior"])
+                elif entry["type"] == "embed":
+                    embedded.setdefault(entry["file"], entry["prior"])
+
+        # the workers log the images as they change them, including those of
+        # an interrupted run that its resume then records with their new tags
+        images = logged
+        for file, prior in embedded.items():
+            images.setdefault(file, prior)
+
+        return sidecars, images
+
+    def _logged_priors(self) -> dict[str, dict | None]:
+        """
+        Prior GPS tags of the images in the worker logs, oldest log first
+        """
+        images = {}
+        for log in sorted(self.priors_logs(), key=lambda path: path.stat().st_mtime):
+            with open(log, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    images.setdefault(entry["file"], entry["prior"])
+
+        return images
+
+    def priors_logs(self) -> list[Path]:
+        """
+        Files the worker processes of an embedded job record the prior GPS tags
+        of each image in, before changing it
+        """
+        return list(self.path.parent.glob(f"{self.id}.*.priors"))
+
+    def _remove_priors_logs(self):
+        for log in self.priors_logs():
+            try:
+                log.unlink()
+            except OSError as e:
+                print(f"Error removing priors log {log}: {e}")
+
+    @property
+    def in_doubt(self) -> list[str]:
+        """
+        Sidecars whose write started but was never committed
+        """
+        return [sidecar for sidecar in self.begun if sidecar not in self.committed]
+
+    def _append(self, entry: dict, sync: bool = False):
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def is_committed(self, sidecar: Path) -> bool:
+        return str(sidecar) in self.committed
+
+    def begin(self, sidecar: Path, latitude: float, longitude: float):
+        sidecar = str(sidecar)
+        entry = {
+            "type": "write",
+            "sidecar": sidecar,
+            "latitude": latitude,
+            "longitude": longitude,
+        }
+        if sidecar not in self.begun:
+            try:
+                with open(sidecar, "rb") as file:
+                    entry["prior"] = base64.b64encode(file.read()).decode()
+            except FileNotFoundError:
+                entry["prior"] = None
+            self.begun.add(sidecar)
+
+        self._append(entry)
+
+    def commit(self, sidecar: Path):
+        self.committed.add(str(sidecar))
+        self._pending += 1
+        self._append(
+            {"type": "commit", "sidecar": str(sidecar)},
+            sync=self._pending % sync_interval == 0,
+        )
+
+    def embed(self, file: Path, prior: dict | None, latitude: float, longitude: float):
+        """
+        Records the coordinates written into an image and its prior GPS tags
+        """
+        file = str(file)
+        self.committed.add(file)
+        self._pending += 1
+        self._append(
+            {
+                "type": "embed",
+                "file": file,
+                "prior": prior,
+                "latitude": latitude,
+                "longitude": longitude,
+            },
+            sync=self._pending % sync_interval == 0,
+        )
+
+    def finish(self):
+        """
+        Marks the job done, keeping the prior GPS tags logged by the workers
+        in the journal so the logs can be deleted
+        """
+        self.finished = True
+        for file, prior in self._logged_priors().items():
+            self._append({"type": "prior", "file": file, "prior": prior})
+        self._append({"type": "done", "finished": time()}, sync=True)
+        self.close()
+        self._remove_priors_logs()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    @staticmethod
+    def _restore(sidecar: str, prior: str | None):
+        if prior is None:
+            Path(sidecar).unlink(missing_ok=True)
+        else:
+            Path(sidecar).write_bytes(base64.b64decode(prior))
+
+    def recover(self):
+        """
+        Restores the sidecars left half written so they are written again
+        """
+        in_doubt = self.in_doubt
+        if not in_doubt:
+            return
+
+        sidecars, _ = self.priors()
+        for sidecar in in_doubt:
+            self._restore(sidecar, sidecars[sidecar])
+
+    def rollback(self) -> int:
+        """
+        Puts back every sidecar touched by the job as it was before the job,
+        and the GPS tags of the images it wrote into. Returns the number of
+        files restored, none for a job already rolled back
+        """
+        if self.rolled_back:
+            return 0
+
+        sidecars, images = self.priors()
+        for sidecar, prior in reversed(list(sidecars.items())):
+            try:
+                self._restore(sidecar, prior)
+            except Exception as e:
+                print(f"Error restoring sidecar {sidecar}: {e}")
+
+        if images:
+            from embedded import restore_embedded_gps
+
+        for file, prior in reversed(list(images.items())):
+            try:
+                restore_embedded_gps(Path(file), prior, self.preserve_mtime)
+            except Exception as e:
+                print(f"Error restoring GPS data of {file}: {e}")
+
+        self.rolled_back = True
+        self._append({"type": "rollback", "finished": time()}, sync=True)
+        self.close()
+        self._remove_priors_logs()
+        get_image_gps.cache_clear()
+        return len(sidecars) + len(images)
+
+
+def run_job(
+    data: list[tuple[str, float, float]],
+    overwrite: bool = False,
+    directory: Path = jobs_path,
+    embedded: bool = False,
+    preserve_mtime: bool = False,
+    progress: Callable[[int, list[tuple[str, str]]], None] | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> Journal:
+    """
+    Writes the coordinates to sidecars, or with embedded into the images, as a
+    journaled job. A job stopped by should_stop is left unfinished, to be
+    resumed or rolled back later
+    """
+    journal = Journal.create(data, overwrite, directory, embedded, preserve_mtime)
+    if create_sidecars(
+        journal.data,
+        overwrite,
+        journal,
+        embedded,
+        preserve_mtime,
+        progress,
+        should_stop,
+    ):
+        journal.finish()
+    else:
+        journal.close()
+    return journal
+
+
+def resume_job(path: Path | str) -> Journal:
+    journal = Journal.open(path)
+    if journal.finished or journal.rolled_back:
+        return journal
+
+    journal.recover()
+    create_sidecars(
+        journal.data,
+        journal.overwrite,
+        journal,
+        journal.embedded,
+        journal.preserve_mtime,
+    )
+    journal.finish()
+    return journal
+
+
+def list_jobs(directory: Path = jobs_path) -> list[Journal]:
+    if not directory.exists():
+        return []
+
+    return [Journal.open(path) for path in sorted(directory.glob("*.jsonl"))]
+
+
+def find_job(job: str, directory: Path = jobs_path) -> Path:
+    path = Path(job)
+    if path.exists():
+        return path
+    return directory / f"{job}.jsonl"
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list")
+    commands.add_parser("resume").add_argument("job")
+    commands.add_parser("rollback").add_argument("job")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for journal in list_jobs():
+            state = (
+                "rolled back"
+                if journal.rolled_back
+                else "finished" if journal.finished else "interrupted"
+            )
+            target = "images" if journal.embedded else "sidecars"
+            print(f"{journal.id}\t{state}\t{len(journal.committed)} {target}")
+    elif args.command == "resume":
+        journal = resume_job(find_job(args.job))
+        print(f"{journal.id}: {len(journal.committed)} sidecars written")
+    else:
+        journal = Journal.open(find_job(args.job))
+        if journal.rolled_back:
+            print(f"{journal.id}: already rolled back")
+        else:
+            print(f"{journal.id}: {journal.rollback()} files restored")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
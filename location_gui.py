@@ -5,6 +5,10 @@ from pathlib import Path
 from nominatim_suggest import NominatimLineEdit
 from map import set_map
 from geo import Coordinates
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from jobs import JobQueue
 
 
 class LocationWindow(QtWidgets.QDialog):
@@ -14,11 +18,14 @@ class LocationWindow(QtWidgets.QDialog):
         files: list[str] | None = None,
         parent: QtWidgets.QWidget | None = None,
         f: QtCore.Qt.WindowType = QtCore.Qt.WindowType.Dialog,
+        jobs: "JobQueue | None" = None,
     ) -> None:
         super().__init__(parent, f)
 
         self.folder = folder
         self.files = files
+        self.jobs = jobs
+        self.location: tuple[str, Coordinates] | None = None
 
         layout = QtWidgets.QVBoxLayout()
 
@@ -47,12 +54,46 @@ class LocationWindow(QtWidgets.QDialog):
         self.web_view.set_html("No location set")
         layout.add_widget(self.web_view, 2)
 
+        options = QtWidgets.QHBoxLayout()
+
+        self.chk_overwrite = QtWidgets.QCheckBox("Overwrite existing locations")
+        options.add_widget(self.chk_overwrite)
+
+        self.chk_embedded = QtWidgets.QCheckBox("Write into the images")
+        self.chk_embedded.tool_tip = "Write JPEG, TIFF and DNG images, not sidecars"
+        options.add_widget(self.chk_embedded)
+
+        self.chk_preserve_mtime = QtWidgets.QCheckBox("Keep modified time")
+        self.chk_preserve_mtime.enabled = False
+        self.chk_embedded.toggled.connect(
+            lambda checked: setattr(self.chk_preserve_mtime, "enabled", checked)
+        )
+        options.add_widget(self.chk_preserve_mtime)
+
+        self.chk_copies = QtWidgets.QCheckBox("Tag copies elsewhere")
+        self.chk_copies.tool_tip = "Tag the copies of the images in other folders too"
+        options.add_widget(self.chk_copies)
+
+        options.add_stretch()
+
+        self.btn_apply = QtWidgets.QPushButton("Apply location")
+        self.btn_apply.enabled = False
+        self.btn_apply.clicked.connect(self.apply_location)
+        options.add_widget(self.btn_apply)
+
+        layout.add_layout(options)
+
         self.set_layout(layout)
+        # hidden only once parented, so it never shows as a window of its own
+        if jobs is None:
+            self.btn_apply.visible = False
 
         self.resize(800, 600)
 
     @QtCore.Slot(str, Coordinates)
     def show_location_on_map(self, name: str, coordinates: Coordinates):
+        self.location = (name, coordinates)
+        self.btn_apply.enabled = True
         set_map(
             self.web_view,
             [coordinates],
@@ -60,3 +101,30 @@ class LocationWindow(QtWidgets.QDialog):
             descriptions=[name],
             draggable=True,
         )
+
+    @QtCore.Slot()
+    def apply_location(self):
+        """
+        Queues the tagging of the folder or files with the selected location
+        and closes the dialog, the job running in the background
+        """
+        if not self.location or self.jobs is None:
+            return
+
+        name, (latitude, longitude) = self.location
+        if self.files:
+            data = [(file, latitude, longitude) for file in self.files]
+            title = f"{len(self.files)} images in {Path(self.folder).name} - {name}"
+        else:
+            data = [(self.folder, latitude, longitude)]
+            title = f"{Path(self.folder).name} - {name}"
+
+        self.jobs.submit(
+            shorten(title, width=80, placeholder="..."),
+            data,
+            overwrite=self.chk_overwrite.checked,
+            embedded=self.chk_embedded.checked,
+            preserve_mtime=self.chk_preserve_mtime.checked,
+            copies=self.chk_copies.checked,
+        )
+        self.accept()
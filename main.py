@@ -1,4 +1,7 @@
+import timing
 from main_gui import load_gui
 
+timing.mark("imports")
+
 if __name__ == "__main__":
     load_gui()
@@ -1,17 +1,81 @@
 import sys
 import io
+import threading
 from pathlib import Path
-from PySide6 import QtCore, QtWidgets, QtGui, QtWebEngineWidgets
+from PySide6 import QtCore, QtWidgets, QtGui
 from __feature__ import snake_case, true_property
 from geo import (
     images_extensions,
     Coordinates,
     get_image_gps,
+    gps_coordinates,
     GPS,
 )
-from location_gui import LocationWindow
-from map import set_map
+from catalog import Catalog, Filter
 from pictures_model import PicturesModel
+from prefetch import PrefetchScheduler
+from jobs import JobQueue
+from jobs_gui import JobsWidget
+from instrumentation import instrument
+from thumbnails import icon_size, popup_html, thumbnail_size
+import timing
+
+# modules that are slow to import (web engine, folium, geopy) and only needed
+# once the user interacts with the map or the location dialog
+deferred_modules = ["map", "geopy.geocoders"]
+
+# amount of rows past the visible ones that have their metadata prefetched
+prefetch_row_count = 200
+
+# map popups showing the thumbnail of their image, linked from the disk cache
+# so the map page stays light for large selections
+max_popup_thumbnails = 1000
+
+
+def warm_up_modules():
+    for name in deferred_modules:
+        try:
+            timing.timed_import(name)
+        except Exception as e:
+            print(f"Error preloading module {name}: {e}")
+
+    # written once the deferred imports are done, so the report includes them
+    timing.mark("modules preloaded")
+    timing.write_report()
+
+
+class ExportSignals(QtCore.QObject):
+    finished = QtCore.Signal(str, int)
+
+
+class ExportWorker(QtCore.QRunnable):
+    """
+    Reads the images of a folder tree not in the catalog yet, including the
+    subfolders never opened, then exports their locations in a pool thread.
+    Cancelling stops the reading and skips the export
+    """
+
+    def __init__(self, catalog: Catalog, folder: str, path: str):
+        super().__init__()
+        self.catalog = catalog
+        self.folder = folder
+        self.path = path
+        self.signals = ExportSignals()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        count = -1
+        try:
+            export_locations = timing.timed_import("export").export_locations
+            self.catalog.scan_tree(self.folder, should_stop=self.cancelled.is_set)
+            if not self.cancelled.is_set():
+                count = export_locations(self.folder, self.path, catalog=self.catalog)
+        except Exception as e:
+            print(f"Error exporting locations to {self.path}: {e}")
+        self.signals.finished.emit(self.path, count)
 
 
 class MainWindow(QtWidgets.QMainWindow):
@@ -27,8 +91,10 @@ class MainWindow(QtWidgets.QMainWindow):
 
         layout = QtWidgets.QGridLayout()
 
+        self.first_paint = False
+        self.export_worker: ExportWorker | None = None
+
         self.folder_model = QtWidgets.QFileSystemModel()
-        self.folder_model.set_root_path("")
         self.folder_model.set_filter(
             QtCore.QDir.Filter.AllDirs
             | QtCore.QDir.Filter.NoDotAndDotDot
@@ -45,19 +111,28 @@ class MainWindow(QtWidgets.QMainWindow):
 
         layout.add_widget(self.folder_tree, 0, 0)
 
-        self.web_view = QtWebEngineWidgets.QWebEngineView()
-        self.web_view.set_html("No map data")
+        # the web view is only created when a map is first needed, until then
+        # a plain label takes its place
+        self._web_view = None
+        self.map_placeholder = QtWidgets.QLabel("No map data")
+        self.map_placeholder.alignment = QtCore.Qt.AlignmentFlag.AlignCenter
+
+        self.map_stack = QtWidgets.QStackedWidget()
+        self.map_stack.add_widget(self.map_placeholder)
+
+        # preview of the current image, from its embedded thumbnail
+        self.preview_path: str | None = None
+        self.preview = QtWidgets.QLabel()
+        self.preview.alignment = QtCore.Qt.AlignmentFlag.AlignCenter
+        self.preview.minimum_height = thumbnail_size
 
         v_layout = QtWidgets.QVBoxLayout()
-        v_layout.add_widget(self.web_view)
+        v_layout.add_widget(self.map_stack, 1)
+        v_layout.add_widget(self.preview)
 
         layout.add_layout(v_layout, 0, 1, 2, 1)
 
-        self.pictures_model = PicturesModel()  # QtWidgets.QFileSystemModel()
-        self.pictures_model.set_filter(QtCore.QDir.Filter.Files)
-        extensions = [f"*{ext}" for ext in images_extensions]
-        self.pictures_model.set_name_filters(extensions)
-        self.pictures_model.name_filter_disables = False
+        self.pictures_model = PicturesModel(self)
 
         self.pictures_table = QtWidgets.QTableView(parent=self)
         self.pictures_table.set_model(self.pictures_model)
@@ -71,8 +146,16 @@ class MainWindow(QtWidgets.QMainWindow):
             QtWidgets.QAbstractItemView.SelectionMode.MultiSelection
         )
 
+        # fixed height rows, so scrolling does not measure the thumbnails
+        self.pictures_table.icon_size = QtCore.QSize(icon_size, icon_size)
+        rows_header = self.pictures_table.vertical_header()
+        rows_header.set_section_resize_mode(QtWidgets.QHeaderView.ResizeMode.Fixed)
+        rows_header.default_section_size = icon_size + 4
+
         # pictures_tree.set_root_index(pictures_model.index(""))
         self.pictures_table.enabled = False
+        self.pictures_table.sorting_enabled = True
+        self.pictures_table.sort_by_column(0, QtCore.Qt.SortOrder.AscendingOrder)
 
         # policy = QtWidgets.QSizePolicy(
         #    QtWidgets.QSizePolicy.Policy.Expanding,
@@ -110,7 +193,51 @@ class MainWindow(QtWidgets.QMainWindow):
         # pictures_header.stretch_last_section = True
         self.pictures_table.resize_columns_to_contents()
 
-        layout.add_widget(self.pictures_table, 0, 2)
+        filter_layout = QtWidgets.QHBoxLayout()
+
+        self.cmb_tagged = QtWidgets.QComboBox()
+        self.cmb_tagged.add_item("All images", None)
+        self.cmb_tagged.add_item("Tagged", True)
+        self.cmb_tagged.add_item("Untagged", False)
+        self.cmb_tagged.currentIndexChanged.connect(lambda _: filter_changed(self))
+        filter_layout.add_widget(self.cmb_tagged)
+
+        # the minimum date is shown as "Any" and leaves that end of the range open
+        self.dte_start, self.dte_end = QtWidgets.QDateEdit(), QtWidgets.QDateEdit()
+        for label, date_edit in [("From", self.dte_start), ("To", self.dte_end)]:
+            date_edit.calendar_popup = True
+            date_edit.display_format = "yyyy-MM-dd"
+            date_edit.minimum_date = QtCore.QDate(1900, 1, 1)
+            date_edit.special_value_text = "Any"
+            date_edit.date = date_edit.minimum_date
+            date_edit.dateChanged.connect(lambda _: filter_changed(self))
+            filter_layout.add_widget(QtWidgets.QLabel(label))
+            filter_layout.add_widget(date_edit)
+
+        pictures_layout = QtWidgets.QVBoxLayout()
+        pictures_layout.add_layout(filter_layout)
+        pictures_layout.add_widget(self.pictures_table)
+
+        layout.add_layout(pictures_layout, 0, 2)
+
+        # rows below the visible ones and the neighbouring folders are read in
+        # the background once scrolling settles
+        self.prefetch = PrefetchScheduler(self.pictures_model.catalog, self)
+        self.prefetch.prefetched.connect(self.pictures_model.folder_scanned)
+
+        self.prefetch_timer = QtCore.QTimer(self)
+        self.prefetch_timer.single_shot_ = True
+        self.prefetch_timer.interval = 200
+        self.prefetch_timer.timeout.connect(lambda: prefetch_rows(self))
+
+        self.pictures_table.vertical_scroll_bar().valueChanged.connect(
+            self.prefetch_timer.start
+        )
+        self.pictures_model.modelReset.connect(self.prefetch_timer.start)
+
+        self.pictures_model.thumbnails.loaded.connect(
+            lambda path: show_preview(self) if path == self.preview_path else None
+        )
 
         self.folder_tree.activated.connect(
             lambda item: folder_selected(
@@ -142,29 +269,110 @@ class MainWindow(QtWidgets.QMainWindow):
         widget.set_layout(layout)
         self.set_central_widget(widget)
 
+        # locations applied from the dialogs are written in the background,
+        # refreshing the folders and the map as their jobs finish
+        self.jobs = JobQueue(self.pictures_model.catalog, self)
+        self.jobs.signals.folder_updated.connect(lambda folder: job_done(self, folder))
+
+        self.jobs_dock = QtWidgets.QDockWidget("Tagging jobs", self)
+        self.jobs_dock.object_name = "jobs_dock"
+        self.jobs_dock.set_widget(JobsWidget(self.jobs))
+        self.add_dock_widget(
+            QtCore.Qt.DockWidgetArea.BottomDockWidgetArea, self.jobs_dock
+        )
+        self.jobs_dock.hide()
+        self.jobs.signals.submitted.connect(lambda _: self.jobs_dock.show())
+
+        tools_menu = self.menu_bar().add_menu("&Tools")
+        export_action = tools_menu.add_action("&Export locations...")
+        export_action.triggered.connect(lambda: open_export_dlg(self))
+        stats_action = tools_menu.add_action("&Statistics...")
+        stats_action.triggered.connect(lambda: open_stats_dlg(self))
+        tools_menu.add_action(self.jobs_dock.toggle_view_action())
+
+        # an export reading a large tree would otherwise keep the application
+        # from quitting until it is done
+        app = QtCore.QCoreApplication.instance()
+        if app:
+            app.aboutToQuit.connect(lambda: cancel_export(self))
+
         # images_model = QtWidgets.QFileSystemModel(widget)
 
+    @property
+    def web_view(self):
+        if self._web_view is None:
+            QtWebEngineWidgets = timing.timed_import("PySide6.QtWebEngineWidgets")
+            self._web_view = QtWebEngineWidgets.QWebEngineView()
+            self.map_stack.add_widget(self._web_view)
+            timing.mark("web view created")
+
+        return self._web_view
+
+    def show_map_message(self, message: str):
+        if self._web_view is None:
+            self.map_placeholder.text = message
+        else:
+            self._web_view.set_html(message)
+
+    def paint_event(self, event: QtGui.QPaintEvent):
+        super().paint_event(event)
+
+        if not self.first_paint:
+            self.first_paint = True
+            timing.mark("first paint")
+            QtCore.QTimer.single_shot(0, self.after_first_paint)
+
+    def after_first_paint(self):
+        # populating the drives list touches every mounted volume, so it is
+        # left for after the window is on screen
+        self.folder_model.set_root_path("")
+        threading.Thread(target=warm_up_modules, daemon=True).start()
+
 
 def folder_selected(
     self: MainWindow,
     item: QtCore.QModelIndex,
 ):
     # print(folder_model.file_path(item))
-    self.pictures_model.set_root_path(self.folder_model.file_path(item))
-    self.pictures_table.set_root_index(
-        self.pictures_model.index(self.folder_model.file_path(item))
-    )
+    self.pictures_model.set_folder(self.folder_model.file_path(item))
+    self.prefetch.folder_selected(self.folder_model.file_path(item))
     # pictures_header = pictures_tree.header()
     # pictures_header.resize_sections(QtWidgets.QHeaderView.ResizeMode.Stretch)
     self.pictures_table.enabled = True
 
-    self.web_view.set_html("No map data")
+    self.show_map_message("No map data")
+    self.preview_path = None
+    show_preview(self)
 
     self.pictures_table.visible = False
     self.pictures_table.resize_columns_to_contents()
     self.pictures_table.visible = True
 
 
+def prefetch_rows(self: MainWindow):
+    viewport = self.pictures_table.viewport()
+    last = self.pictures_table.row_at(viewport.height - 1)
+    if last < 0:
+        last = self.pictures_model.row_count() - 1
+
+    self.prefetch.prefetch_paths(
+        self.pictures_model.unscanned_paths(last + 1, prefetch_row_count)
+    )
+
+
+def filter_changed(self: MainWindow):
+    start, end = [
+        (
+            None
+            if date_edit.date == date_edit.minimum_date
+            else date_edit.date.to_string("yyyy-MM-dd")
+        )
+        for date_edit in [self.dte_start, self.dte_end]
+    ]
+    self.pictures_model.set_filter(Filter(self.cmb_tagged.current_data(), start, end))
+
+
+@instrument()
 def image_selected(
     self: MainWindow,
     # item: QtCore.QModelIndex,
@@ -175,27 +383,76 @@ def image_selected(
     # path = Path(pictures_model.file_path(item))
     markers = []
     rows = []
+    descriptions = []
 
-    for index in self.pictures_table.selected_indexes():
-        path = Path(self.pictures_model.file_path(index))
+    current = self.pictures_table.selection_model().current_index
+    self.preview_path = (
+        self.pictures_model.file_path(current) if current.is_valid() else None
+    )
+    show_preview(self)
 
-        gps_info = get_image_gps(path)
-        if gps_info:
-            gps_data = GPS.from_exif(
-                gps_info["GPSLatitude"],
-                gps_info["GPSLatitudeRef"],
-                gps_info["GPSLongitude"],
-                gps_info["GPSLongitudeRef"],
-            )
-            markers.append(gps_data.coordinates)
+    for index in self.pictures_table.selection_model().selected_rows():
+        record = self.pictures_model.record(index)
+
+        # images the catalog has not read yet are read directly
+        if record.scanned:
+            coordinates = record.coordinates
+        else:
+            coordinates = gps_coordinates(get_image_gps(Path(record.path)))
+
+        if coordinates:
+            markers.append(coordinates)
             rows.append(index.row() + 1)
+            description = (
+                popup_html(record.path, record.mtime, record.name)
+                if len(descriptions) < max_popup_thumbnails
+                else None
+            )
+            descriptions.append(
+                description or f"{coordinates.latitude}, {coordinates.longitude}"
+            )
             # set_map(web_view, [gps_data.coordinates], [pictures_model.get_number(item)])
             # set_map(web_view, [gps_data.coordinates], [item.row()])
 
     if markers:
-        set_map(self.web_view, markers, rows)
+        set_map = timing.timed_import("map").set_map
+        set_map(self.web_view, markers, rows, descriptions)
+        self.map_stack.set_current_widget(self.web_view)
+    else:
+        self.show_map_message("No map data")
+
+
+def show_preview(self: MainWindow):
+    """
+    Shows the thumbnail of the current image, once it is loaded
+    """
+    self.preview.text = ""
+    if not self.preview_path:
+        self.preview.pixmap = QtGui.QPixmap()
+        return
+
+    record = self.pictures_model.catalog.record(self.preview_path)
+    if not record:
+        return
+
+    thumbnail = self.pictures_model.thumbnails.get(record.path, record.mtime)
+    if thumbnail is None:
+        self.preview.text = "Loading preview..."
+    elif thumbnail.image.is_null():
+        self.preview.text = "No preview"
     else:
-        self.web_view.set_html("No map data")
+        self.preview.pixmap = QtGui.QPixmap.from_image(thumbnail.image)
+
+
+def job_done(self: MainWindow, folder: str):
+    """
+    Shows the locations a job wrote to the current folder
+    """
+    if folder != self.pictures_model.folder:
+        return
+
+    self.pictures_model.refresh()
+    image_selected(self, QtCore.QItemSelection(), QtCore.QItemSelection())
 
 
 def open_folder_location_dlg(self: MainWindow):
@@ -204,7 +461,8 @@ def open_folder_location_dlg(self: MainWindow):
 
     path = self.folder_model.file_path(self.folder_tree.selected_indexes()[0])
     print(path)
-    dlg = LocationWindow(path)
+    LocationWindow = timing.timed_import("location_gui").LocationWindow
+    dlg = LocationWindow(path, parent=self, jobs=self.jobs)
     dlg.exec()
 
 
@@ -219,16 +477,70 @@ def open_files_location_dlg(self: MainWindow):
 
     files = [
         self.pictures_model.file_path(index)
-        for index in self.pictures_table.selected_indexes()
+        for index in self.pictures_table.selection_model().selected_rows()
     ]
 
-    dlg = LocationWindow(folder, files)
+    LocationWindow = timing.timed_import("location_gui").LocationWindow
+    dlg = LocationWindow(folder, files, parent=self, jobs=self.jobs)
     dlg.exec()
 
 
+def open_export_dlg(self: MainWindow):
+    if not self.folder_tree.selected_indexes():
+        return
+
+    if self.export_worker:
+        self.status_bar().show_message("An export is already running")
+        return
+
+    folder = self.folder_model.file_path(self.folder_tree.selected_indexes()[0])
+    path, _ = QtWidgets.QFileDialog.get_save_file_name(
+        self,
+        "Export locations",
+        str(Path(folder) / "locations.geojson"),
+        "GeoJSON (*.geojson);;KML (*.kml);;GPX (*.gpx);;CSV (*.csv)",
+    )
+    if not path:
+        return
+
+    self.export_worker = ExportWorker(self.pictures_model.catalog, folder, path)
+    self.export_worker.set_auto_delete(False)
+    self.export_worker.signals.finished.connect(
+        lambda path, count: export_finished(self, path, count)
+    )
+    self.status_bar().show_message(f"Reading the images under {folder}...")
+    QtCore.QThreadPool.global_instance().start(self.export_worker)
+
+
+def cancel_export(self: MainWindow):
+    if self.export_worker:
+        self.export_worker.cancel()
+
+
+def export_finished(self: MainWindow, path: str, count: int):
+    self.export_worker = None
+    self.status_bar().show_message(
+        f"{count} locations exported to {path}"
+        if count >= 0
+        else f"Error exporting locations to {path}"
+    )
+
+
+def open_stats_dlg(self: MainWindow):
+    StatsWindow = timing.timed_import("stats_gui").StatsWindow
+    dlg = StatsWindow(self)
+    dlg.show()
+
+
 def load_gui():
+    # required by the web engine when it is imported after the application
+    QtCore.QCoreApplication.set_attribute(
+        QtCore.Qt.ApplicationAttribute.AA_ShareOpenGLContexts
+    )
     app = QtWidgets.QApplication([])
+    timing.mark("application created")
     widget = MainWindow()
+    timing.mark("window created")
     widget.show_maximized()
 
     sys.exit(app.exec())
@@ -1,82 +1,87 @@
-from PySide6 import QtWebEngineWidgets
+from PySide6 import QtCore
 from __feature__ import snake_case, true_property
+from cluster import geo_bounds, spherical_center
 from geo import Coordinates
+from instrumentation import instrument
+from typing import TYPE_CHECKING
 import folium
 import folium.plugins as fplugins
 import io
-import math
+import os
+import tempfile
+from pathlib import Path
+
+# set_html cannot display pages over 2 MB once encoded, larger ones are loaded
+# from a file
+max_html_size = 1024 * 1024
+page_path = os.path.join(tempfile.gettempdir(), f"smartgeotag-map-{os.getpid()}.html")
+
+if TYPE_CHECKING:
+    # only needed for annotations, the web engine is loaded by the gui on demand
+    from PySide6 import QtWebEngineWidgets
 
 
 def center(coordinates: list[Coordinates]) -> Coordinates:
     """
     Provides the central coordinate based on a list of coordinates
     """
-    if not coordinates:
-        return Coordinates(0, 0)
-
-    qtd_coords = len(coordinates)
-    x, y, z = 0.0, 0.0, 0.0
-    for coord in coordinates:
-        latitude = coord.latitude * math.pi / 180
-        longitude = coord.longitude * math.pi / 180
-
-        x += math.cos(latitude) * math.cos(longitude)
-        y += math.cos(latitude) * math.sin(longitude)
-        z += math.sin(latitude)
-
-    x, y, z = [val / qtd_coords for val in (x, y, z)]
-    longitude = math.atan2(y, x)
-    hypotenuse = math.sqrt(x * x + y * y)
-    latitude = math.atan2(z, hypotenuse)
-
-    return Coordinates(latitude * 180 / math.pi, longitude * 180 / math.pi)
+    return spherical_center(coordinates)
 
 
 def bounds(coordinates: list[Coordinates]) -> tuple[Coordinates, Coordinates]:
     """
-    Extract the top left edge and the bottom right edge from a list of coordinates
+    Extract the south west edge and the north east edge from a list of
+    coordinates, the west longitude being greater than the east one when they
+    cross the antimeridian
     """
     if not coordinates:
-        return Coordinates(0, 0)
+        return Coordinates(0, 0), Coordinates(0, 0)
 
-    if len(coordinates) == 1:
-        return coordinates[0], coordinates[0]
+    return geo_bounds(coordinates)
 
-    top_left = Coordinates(*map(min, zip(*coordinates)))
-    bottom_right = Coordinates(*map(max, zip(*coordinates)))
 
-    return top_left, bottom_right
+def unwrap(coordinates: Coordinates, west: float) -> Coordinates:
+    """
+    Moves a longitude west of the bounds one turn east, so leaflet draws bounds
+    crossing the antimeridian as one continuous area
+    """
+    if coordinates.longitude < west:
+        return Coordinates(coordinates.latitude, coordinates.longitude + 360)
+    return coordinates
 
 
 def bounds_and_center(
     coordinates: list[Coordinates],
-) -> tuple[tuple[Coordinates, Coordinates], Coordinates]:
+) -> tuple[tuple[Coordinates, Coordinates] | None, Coordinates]:
     """
-    Extract the top left edge and the bottom right edge from a list of coordinates
+    Extract the south west edge and the north east edge from a list of
+    coordinates, with the east edge unwrapped past 180 when they cross the
+    antimeridian, and their center
     """
     if not coordinates:
-        return Coordinates(0, 0)
+        return None, Coordinates(0, 0)
 
     if len(coordinates) == 1:
         return None, coordinates[0]
 
-    top_left = Coordinates(*map(min, zip(*coordinates)))
-    bottom_right = Coordinates(*map(max, zip(*coordinates)))
-    center = Coordinates(
-        (top_left.latitude + bottom_right.latitude) / 2,
-        (top_left.longitude + bottom_right.longitude) / 2,
-    )
+    south_west, north_east = geo_bounds(coordinates)
+    north_east = unwrap(north_east, south_west.longitude)
 
-    return (top_left, bottom_right), center
+    return (south_west, north_east), unwrap(
+        spherical_center(coordinates), south_west.longitude
+    )
 
 
-def set_map(
-    web_view: QtWebEngineWidgets.QWebEngineView,
+@instrument()
+def map_html(
     coordinates: list[Coordinates],
     markers: list[str] = [],
     descriptions: list[str] = [],
     draggable=False,
-):
+) -> str:
+    """
+    Renders the folium map with one marker per coordinate as a html page
+    """
     if not coordinates:
         raise Exception("No valid coordinates passed")
 
@@ -88,6 +93,8 @@ def set_map(
         raise Exception("Descriptions does not match the amount of Coordinates")
 
     bounds, center = bounds_and_center(coordinates)
+    # keep the markers on the same side of the antimeridian as the bounds
+    west = bounds[0].longitude if bounds else -180
 
     map = folium.Map(title="Coordinates", zoom_start=13, location=center)
     for i in range(len(coordinates)):
@@ -107,7 +114,7 @@ def set_map(
                 background_color="blue",
             ),
             # icon=folium.Icon(icon="9", prefix="fa", color="blue"),
-            location=(coordinates[i].latitude, coordinates[i].longitude),
+            location=tuple(unwrap(coordinates[i], west)),
             popup=description,
             draggable=draggable,
         ).add_to(map)
@@ -117,11 +124,34 @@ def set_map(
 
     data = io.BytesIO()
     map.save(data, close_file=False)
-    web_view.set_html(data.getvalue().decode())
+    return data.getvalue().decode()
+
+
+@instrument()
+def set_map(
+    web_view: "QtWebEngineWidgets.QWebEngineView",
+    coordinates: list[Coordinates],
+    markers: list[str] = [],
+    descriptions: list[str] = [],
+    draggable=False,
+):
+    html = map_html(coordinates, markers, descriptions, draggable)
+
+    # popups link local thumbnails while leaflet and the tiles are remote
+    settings = web_view.settings()
+    attributes = type(settings).WebAttribute
+    settings.set_attribute(attributes.LocalContentCanAccessFileUrls, True)
+    settings.set_attribute(attributes.LocalContentCanAccessRemoteUrls, True)
+
+    if len(html.encode()) < max_html_size:
+        web_view.set_html(html, QtCore.QUrl.from_local_file(page_path))
+    else:
+        Path(page_path).write_text(html, encoding="utf-8")
+        web_view.load(QtCore.QUrl.from_local_file(page_path))
     # web_view.set_html(map._repr_html_())
 
 
 def get_markers(
-    web_view: QtWebEngineWidgets.QWebEngineView,
+    web_view: "QtWebEngineWidgets.QWebEngineView",
 ) -> list[tuple[str, str, Coordinates]]:
     map = folium.Map(title="Coordinates", zoom_start=13, location=center)
@@ -1,23 +1,254 @@
-from PySide6 import QtCore, QtWidgets, QtGui, QtWebEngineWidgets
+from PySide6 import QtCore, QtWidgets, QtGui
 from __feature__ import snake_case, true_property
+import threading
 import typing
 from pathlib import Path
-from geo import get_image_gps
+from catalog import Catalog, Filter, Record, get_catalog
+from instrumentation import instrument
+from thumbnails import ThumbnailLoader
 
+page_size = 500
+# milliseconds between refreshes of the rows while a folder is read
+refresh_interval = 250
 
-class PicturesModel(QtWidgets.QFileSystemModel):
+
+class ScanSignals(QtCore.QObject):
+    synced = QtCore.Signal(str)
+    progress = QtCore.Signal(str, int, int)
+    finished = QtCore.Signal(str)
+
+
+class ScanWorker(QtCore.QRunnable):
     """
-    Add a index column to the QFileSystemModel, so the user can know
-    which selected image represents which tag
+    Syncs a folder with the catalog and reads the metadata of its new or
+    changed images in a pool thread
     """
 
+    def __init__(self, catalog: Catalog, folder: str):
+        super().__init__()
+        self.catalog = catalog
+        self.folder = folder
+        self.signals = ScanSignals()
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        self.catalog.sync_folder(self.folder)
+        self.signals.synced.emit(self.folder)
+
+        pending = self.catalog.pending(self.folder)
+        self.catalog.read_metadata(
+            pending,
+            should_stop=self.cancelled.is_set,
+            progress=lambda done: self.signals.progress.emit(
+                self.folder, done, len(pending)
+            ),
+        )
+        self.signals.finished.emit(self.folder)
+
+
+class PicturesModel(QtCore.QAbstractTableModel):
+    """
+    Lists the images of a folder from the catalog, fetching rows in pages as
+    the view scrolls. Sorting and filtering are done by the catalog queries,
+    and the GeoTag column shows the cached coordinates of each image. Names
+    are decorated with the embedded preview of the image, loaded in the
+    background as the rows are shown
+    """
+
+    columns = ["Name", "Size", "Type", "Date Taken", "GeoTag"]
+    sort_keys = ["name", "size", "suffix", "taken", "tagged"]
+
+    def __init__(
+        self, parent: QtCore.QObject | None = None, catalog: Catalog | None = None
+    ):
+        super().__init__(parent)
+        self.catalog = catalog or get_catalog()
+        self.folder: str | None = None
+        self.filter = Filter()
+        self.order = "name"
+        self.descending = False
+        self.records: list[Record] = []
+        # row of each loaded path, to update the rows as thumbnails arrive
+        self.rows: dict[str, int] = {}
+        self.total = 0
+        self.worker: ScanWorker | None = None
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.max_thread_count = 1
+        self.thumbnails = ThumbnailLoader(self)
+        self.thumbnails.loaded.connect(self.thumbnail_loaded)
+
+        self.refresh_timer = QtCore.QTimer(self)
+        self.refresh_timer.single_shot_ = True
+        self.refresh_timer.interval = refresh_interval
+        self.refresh_timer.timeout.connect(self.refresh)
+
+        app = QtCore.QCoreApplication.instance()
+        if app:
+            app.aboutToQuit.connect(self.cancel_scan)
+
+    def cancel_scan(self):
+        if self.worker:
+            self.worker.cancel()
+
+    def set_folder(self, folder: str):
+        self.cancel_scan()
+        self.thumbnails.cancel()
+
+        self.folder = folder
+        self.reload()
+
+        self.worker = ScanWorker(self.catalog, folder)
+        self.worker.set_auto_delete(False)
+        self.worker.signals.synced.connect(self.folder_scanned)
+        self.worker.signals.progress.connect(self.folder_scanned)
+        self.worker.signals.finished.connect(self.folder_scanned)
+        self.pool.start(self.worker)
+
+    def set_filter(self, filter: Filter):
+        self.filter = filter
+        self.reload()
+
+    def reload(self):
+        self.begin_reset_model()
+        self.records = []
+        self.total = 0
+        if self.folder:
+            self.total = self.catalog.count(self.folder, self.filter)
+            self.records = self._fetch(0, page_size)
+        self._index_rows()
+        self.end_reset_model()
+
+    def refresh(self):
+        """
+        Re-reads the loaded rows after the catalog changed. Rows are added or
+        removed at the end as the amount of images changes, rows moved by the
+        sort order keep their selection, and only the rows that changed are
+        updated in the view
+        """
+        if not self.folder:
+            return
+
+        self.total = self.catalog.count(self.folder, self.filter)
+        records = self._fetch(0, max(len(self.records), page_size))
+
+        if len(records) < len(self.records):
+            self.begin_remove_rows(
+                QtCore.QModelIndex(), len(records), len(self.records) - 1
+            )
+            del self.records[len(records) :]
+            self._index_rows()
+            self.end_remove_rows()
+
+        count = len(self.records)
+        if [record.path for record in records[:count]] != list(self.rows):
+            self.layoutAboutToBeChanged.emit()
+            previous = [
+                (index, self.records[index.row()].path)
+                for index in self.persistent_index_list()
+            ]
+            self.records = records[:count]
+            self._index_rows()
+            for index, path in previous:
+                row = self.rows.get(path)
+                self.change_persistent_index(
+                    index,
+                    (
+                        self.index(row, index.column())
+                        if row is not None
+                        else QtCore.QModelIndex()
+                    ),
+                )
+            self.layoutChanged.emit()
+        else:
+            changed = [row for row in range(count) if records[row] != self.records[row]]
+            if changed:
+                self.records = records[:count]
+                self.dataChanged.emit(
+                    self.index(changed[0], 0),
+                    self.index(changed[-1], len(self.columns) - 1),
+                )
+
+        if len(records) > count:
+            self.begin_insert_rows(QtCore.QModelIndex(), count, len(records) - 1)
+            self.records += records[count:]
+            self._index_rows(count)
+            self.end_insert_rows()
+
+    def folder_scanned(self, folder: str, *args):
+        """
+        Refreshes the rows at most every refresh_interval while a folder is
+        read, rather than on every image
+        """
+        if folder == self.folder and not self.refresh_timer.active:
+            self.refresh_timer.start()
+
+    def thumbnail_loaded(self, path: str):
+        row = self.rows.get(path)
+        if row is not None:
+            index = self.index(row, 0)
+            self.dataChanged.emit(index, index, [QtCore.Qt.ItemDataRole.DecorationRole])
+
+    def _index_rows(self, start: int = 0):
+        if not start:
+            self.rows = {}
+        for row in range(start, len(self.records)):
+            self.rows[self.records[row].path] = row
+
+    def _fetch(self, offset: int, limit: int) -> list[Record]:
+        return self.catalog.records(
+            self.folder, self.filter, self.order, self.descending, offset, limit
+        )
+
+    def row_count(
+        self,
+        parent: (
+            QtCore.QModelIndex | QtCore.QPersistentModelIndex
+        ) = QtCore.QModelIndex(),
+    ) -> int:
+        return 0 if parent.is_valid() else len(self.records)
+
     def column_count(
         self,
         parent: (
             QtCore.QModelIndex | QtCore.QPersistentModelIndex
         ) = QtCore.QModelIndex(),
     ) -> int:
-        return super().column_count(parent) + 1
+        return 0 if parent.is_valid() else len(self.columns)
+
+    def can_fetch_more(
+        self, parent: QtCore.QModelIndex | QtCore.QPersistentModelIndex
+    ) -> bool:
+        return not parent.is_valid() and len(self.records) < self.total
+
+    def fetch_more(self, parent: QtCore.QModelIndex | QtCore.QPersistentModelIndex):
+        records = self._fetch(len(self.records), page_size)
+        if not records:
+            self.total = len(self.records)
+            return
+
+        self.begin_insert_rows(
+            QtCore.QModelIndex(),
+            len(self.records),
+            len(self.records) + len(records) - 1,
+        )
+        self.records += records
+        self._index_rows(len(self.records) - len(records))
+        self.end_insert_rows()
+
+    def sort(
+        self,
+        column: int,
+        order: QtCore.Qt.SortOrder = QtCore.Qt.SortOrder.AscendingOrder,
+    ):
+        if column < 0 or column >= len(self.sort_keys):
+            return
+
+        self.order = self.sort_keys[column]
+        self.descending = order == QtCore.Qt.SortOrder.DescendingOrder
+        self.reload()
 
     def header_data(
         self,
@@ -27,39 +258,72 @@ class PicturesModel(QtWidgets.QFileSystemModel):
     ) -> typing.Any:
         if (
             orientation == QtCore.Qt.Orientation.Horizontal
-            and section == self.column_count() - 1
+            and role == QtCore.Qt.ItemDataRole.DisplayRole
         ):
-            return "GeoTag"
-        else:
-            return super().header_data(section, orientation, role)
+            return self.columns[section]
+        return super().header_data(section, orientation, role)
 
+    @instrument("PicturesModel.data")
     def data(
         self,
         index: QtCore.QModelIndex | QtCore.QPersistentModelIndex,
         role: int = QtCore.Qt.ItemDataRole.DisplayRole,
     ) -> typing.Any:
-        if index.is_valid() and index.column() == self.column_count(index.parent()) - 1:
+        if not index.is_valid() or index.row() >= len(self.records):
+            return None
+
+        record = self.records[index.row()]
+        column = index.column()
+
+        if column == 4:
             if role == QtCore.Qt.ItemDataRole.CheckStateRole:
-                path = Path(self.root_path()) / index.sibling_at_column(0).data(
-                    QtCore.Qt.ItemDataRole.DisplayRole
+                if not record.scanned:
+                    return QtCore.Qt.CheckState.PartiallyChecked
+                return (
+                    QtCore.Qt.CheckState.Checked
+                    if record.latitude is not None
+                    else QtCore.Qt.CheckState.Unchecked
                 )
-                if path.is_file():
-                    return (
-                        QtCore.Qt.CheckState.Checked
-                        if get_image_gps(Path(self.root_path()) / path) is not None
-                        else QtCore.Qt.CheckState.Unchecked
-                    )
-                return QtCore.Qt.CheckState.Unchecked
-            elif role == QtCore.Qt.ItemDataRole.DecorationRole:
-                return QtWidgets.QFileIconProvider.IconType.Computer
-            elif QtCore.Qt.ItemDataRole.TextAlignmentRole:
+            elif role == QtCore.Qt.ItemDataRole.TextAlignmentRole:
                 return QtCore.Qt.AlignmentFlag.AlignHCenter
+            return None
 
-        return super().data(index, role)
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return record.name
+            elif column == 1:
+                return QtCore.QLocale().formatted_data_size(record.size)
+            elif column == 2:
+                return f"{record.suffix[1:].upper()} File"
+            elif column == 3:
+                return record.taken or ""
+        elif role == QtCore.Qt.ItemDataRole.DecorationRole and column == 0:
+            thumbnail = self.thumbnails.get(record.path, record.mtime)
+            if thumbnail and not thumbnail.icon.is_null():
+                return thumbnail.icon
+        elif role == QtCore.Qt.ItemDataRole.ToolTipRole and column == 0:
+            return record.path
 
-    def get_number(
-        self,
-        index: QtCore.QModelIndex | QtCore.QPersistentModelIndex,
-        role: int = QtCore.Qt.ItemDataRole.DisplayRole,
-    ):
-        return index.sibling_at_column(4).data(role)
+        return None
+
+    def unscanned_paths(self, start: int, count: int) -> list[str]:
+        """
+        Paths of the images not read yet among count rows from start, including
+        rows not fetched by the view yet
+        """
+        if not self.folder:
+            return []
+
+        return [
+            record.path for record in self._fetch(start, count) if not record.scanned
+        ]
+
+    def record(
+        self, index: QtCore.QModelIndex | QtCore.QPersistentModelIndex
+    ) -> Record:
+        return self.records[index.row()]
+
+    def file_path(
+        self, index: QtCore.QModelIndex | QtCore.QPersistentModelIndex
+    ) -> str:
+        return self.records[index.row()].path
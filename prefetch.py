@@ -0,0 +1,236 @@
+"""
+Background prefetch of image metadata into the catalog.
+
+While the user looks at a folder, the rows just below the visible ones and the
+sibling and child folders are read at low priority, so scrolling and opening
+the next folder find their metadata already cached. Reads are limited to
+files_per_second and folder prefetching backs off for idle_delay seconds
+whenever the user interacts with the application.
+"""
+
+import os
+import threading
+from collections import deque
+from time import monotonic, sleep
+from typing import Callable
+
+from PySide6 import QtCore
+from __feature__ import snake_case, true_property
+
+from catalog import Catalog, get_catalog
+
+files_per_second = 100
+idle_delay = 1.5
+max_siblings = 4
+max_children = 8
+max_folder_files = 5000
+paths_chunk_size = 50
+# seconds to wait for the file being read when shutting down
+shutdown_timeout = 5
+
+interaction_events = {
+    QtCore.QEvent.Type.KeyPress,
+    QtCore.QEvent.Type.MouseButtonPress,
+    QtCore.QEvent.Type.MouseButtonDblClick,
+    QtCore.QEvent.Type.Wheel,
+}
+
+
+def neighbour_folders(folder: str) -> list[str]:
+    """
+    Sibling folders nearest first, alternating after and before the folder as
+    in a date ordered archive, followed by the child folders
+    """
+    result = []
+
+    parent = os.path.dirname(folder)
+    if parent and parent != folder:
+        try:
+            siblings = sorted(
+                entry.path for entry in os.scandir(parent) if entry.is_dir()
+            )
+        except OSError:
+            siblings = []
+
+        if folder in siblings:
+            position = siblings.index(folder)
+            for distance in range(1, len(siblings)):
+                for index in [position + distance, position - distance]:
+                    if 0 <= index < len(siblings):
+                        result.append(siblings[index])
+            result = result[:max_siblings]
+
+    try:
+        children = sorted(entry.path for entry in os.scandir(folder) if entry.is_dir())
+    except OSError:
+        children = []
+
+    return result + children[:max_children]
+
+
+class PrefetchScheduler(QtCore.QObject):
+    prefetched = QtCore.Signal(str)
+
+    def __init__(
+        self, catalog: Catalog | None = None, parent: QtCore.QObject | None = None
+    ):
+        super().__init__(parent)
+        self.catalog = catalog or get_catalog()
+
+        self.condition = threading.Condition()
+        self.running = True
+        self.folder_generation = 0
+        self.paths_generation = 0
+        self.expand: str | None = None
+        self.folders: deque[str] = deque()
+        self.paths: deque[str] = deque()
+
+        self.paused_until = 0.0
+        self.allowance = float(files_per_second)
+        self.last_refill = monotonic()
+
+        # a daemon thread rather than a pool, which would wait for it when the
+        # scheduler is deleted: the worker only stops on shutdown and would
+        # otherwise keep any other teardown waiting for more work
+        self.worker = threading.Thread(target=self.run, name="prefetch", daemon=True)
+        self.worker.start()
+
+        app = QtCore.QCoreApplication.instance()
+        if app:
+            app.install_event_filter(self)
+            app.aboutToQuit.connect(self.shutdown)
+
+    def folder_selected(self, folder: str):
+        """
+        Drops the pending folders and queues the neighbours of the new one
+        """
+        with self.condition:
+            self.folder_generation += 1
+            self.expand = folder
+            self.folders.clear()
+            self.condition.notify()
+
+    def prefetch_paths(self, paths: list[str]):
+        """
+        Reads the given images ahead of the folders, replacing any images
+        still queued from an earlier call
+        """
+        with self.condition:
+            self.paths_generation += 1
+            self.paths.clear()
+            self.paths.extend(paths)
+            self.condition.notify()
+
+    def user_active(self):
+        self.paused_until = monotonic() + idle_delay
+
+    def event_filter(self, obj: QtCore.QObject, event: QtCore.QEvent):
+        if event.type() in interaction_events:
+            self.user_active()
+        return False
+
+    @QtCore.Slot()
+    def shutdown(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.worker.join(shutdown_timeout)
+
+    def _has_work(self) -> bool:
+        return bool(self.paths or self.expand or self.folders)
+
+    def run(self):
+        QtCore.QThread.current_thread().set_priority(
+            QtCore.QThread.Priority.LowestPriority
+        )
+        self.work()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while self.running and not self._has_work():
+                    self.condition.wait()
+                if not self.running:
+                    return
+                job = self._next_job()
+
+            try:
+                job()
+            except Exception as e:
+                print(f"Error prefetching metadata: {e}")
+
+    def _next_job(self) -> Callable[[], None]:
+        """
+        Picks the next job, called with the condition held
+        """
+        if self.paths:
+            paths = [
+                self.paths.popleft()
+                for _ in range(min(paths_chunk_size, len(self.paths)))
+            ]
+            generation = self.paths_generation
+            return lambda: self._prefetch_paths(paths, generation)
+
+        generation = self.folder_generation
+        if self.expand:
+            folder, self.expand = self.expand, None
+            return lambda: self._expand(folder, generation)
+
+        folder = self.folders.popleft()
+        return lambda: self._prefetch_folder(folder, generation)
+
+    def _expand(self, folder: str, generation: int):
+        folders = neighbour_folders(folder)
+        with self.condition:
+            if generation == self.folder_generation:
+                self.folders.extend(folders)
+
+    def _prefetch_paths(self, paths: list[str], generation: int):
+        pending = [
+            path
+            for path in paths
+            if not (record := self.catalog.record(path)) or not record.scanned
+        ]
+        stale = lambda: generation != self.paths_generation
+        if pending and self.catalog.read_metadata(
+            pending, should_stop=lambda: self._throttle(stale, pausable=False)
+        ):
+            self.prefetched.emit(os.path.dirname(pending[0]))
+
+    def _prefetch_folder(self, folder: str, generation: int):
+        stale = lambda: generation != self.folder_generation
+
+        if self._throttle(stale, pausable=True):
+            return
+
+        self.catalog.sync_folder(folder)
+        pending = self.catalog.pending(folder, max_folder_files)
+        if self.catalog.read_metadata(
+            pending, should_stop=lambda: self._throttle(stale, pausable=True)
+        ):
+            self.prefetched.emit(folder)
+
+    def _throttle(self, stale: Callable[[], bool], pausable: bool) -> bool:
+        """
+        Waits until the read budget allows one more file and, for pausable
+        work, until the user is idle. Returns True when the work should stop
+        """
+        while True:
+            if not self.running or stale():
+                return True
+
+            now = monotonic()
+            if pausable and now < self.paused_until:
+                sleep(min(self.paused_until - now, 0.25))
+                continue
+
+            self.allowance = min(
+                float(files_per_second),
+                self.allowance + (now - self.last_refill) * files_per_second,
+            )
+            self.last_refill = now
+            if self.allowance >= 1:
+                self.allowance -= 1
+                return False
+
+            sleep((1 - self.allowance) / files_per_second)
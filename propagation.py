@@ -0,0 +1,227 @@
+"""
+Location propagation from tagged to untagged photos by capture time.
+
+Photos are sorted by capture time and every untagged photo gets the location
+of the nearest tagged photo within the time window, or the interpolation
+between the tagged photos right before and after it when both are within the
+window. Each result has a confidence between 0 and 1 that decays with the time
+gap, and for interpolations with the distance between the two neighbours.
+
+    python propagation.py ROOT --window 30 --min-confidence 0.5 --apply
+"""
+
+import argparse
+import calendar
+import math
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, NamedTuple
+
+from catalog import Catalog, Record, get_catalog
+from geo import Coordinates
+from journal import run_job
+
+default_window = 30 * 60
+# distance between the two neighbours at which an interpolation has its
+# confidence reduced to about a third
+spread_km = 5.0
+earth_radius_km = 6371.0
+
+
+class Inference(NamedTuple):
+    path: str
+    coordinates: Coordinates
+    confidence: float
+    method: str
+    gap: float
+
+
+def timestamp(taken: str | None) -> float | None:
+    """
+    Seconds of a catalog capture time, taken as UTC so daylight saving changes
+    do not distort the gaps
+    """
+    if not taken:
+        return None
+
+    try:
+        return calendar.timegm(datetime.fromisoformat(taken).timetuple())
+    except ValueError:
+        return None
+
+
+def haversine_km(a: Coordinates, b: Coordinates) -> float:
+    latitude_a, latitude_b = math.radians(a.latitude), math.radians(b.latitude)
+    delta_latitude = latitude_b - latitude_a
+    delta_longitude = math.radians(b.longitude - a.longitude)
+    h = (
+        math.sin(delta_latitude / 2) ** 2
+        + math.cos(latitude_a)
+        * math.cos(latitude_b)
+        * math.sin(delta_longitude / 2) ** 2
+    )
+    return 2 * earth_radius_km * math.asin(min(1.0, math.sqrt(h)))
+
+
+def interpolate(a: Coordinates, b: Coordinates, fraction: float) -> Coordinates:
+    """
+    Linear interpolation taking the short way around the antimeridian
+    """
+    delta_longitude = (b.longitude - a.longitude + 180) % 360 - 180
+    longitude = a.longitude + delta_longitude * fraction
+    return Coordinates(
+        a.latitude + (b.latitude - a.latitude) * fraction,
+        (longitude + 180) % 360 - 180,
+    )
+
+
+def infer_locations(
+    records: Iterable[Record],
+    window: float = default_window,
+    interpolation: bool = True,
+) -> list[Inference]:
+    """
+    Infers locations for the untagged records with a capture time. Sorting
+    makes it O(n log n), the neighbours are found in two linear passes
+    """
+    photos = []
+    for record in records:
+        if not record.scanned:
+            continue
+        seconds = timestamp(record.taken)
+        if seconds is not None:
+            photos.append((seconds, record.path, record.coordinates))
+
+    photos.sort(key=lambda photo: photo[0])
+
+    previous: list[int | None] = [None] * len(photos)
+    last = None
+    for i, (_, _, coordinates) in enumerate(photos):
+        previous[i] = last
+        if coordinates:
+            last = i
+
+    result = []
+    following = None
+    for i in range(len(photos) - 1, -1, -1):
+        seconds, path, coordinates = photos[i]
+        if coordinates:
+            following = i
+            continue
+
+        candidates = []
+        for neighbour in [previous[i], following]:
+            if neighbour is not None:
+                gap = abs(seconds - photos[neighbour][0])
+                if gap <= window:
+                    candidates.append((gap, photos[neighbour][2]))
+
+        if not candidates:
+            continue
+
+        gap, coordinates = min(candidates, key=lambda candidate: candidate[0])
+        inference = Inference(path, coordinates, 1 - gap / window, "nearest", gap)
+
+        # neighbours far apart make the interpolation a guess, so the nearest
+        # neighbour is kept when it is more reliable
+        if interpolation and len(candidates) == 2:
+            (gap_before, before), (gap_after, after) = candidates
+            span = gap_before + gap_after
+            fraction = gap_before / span if span else 0.5
+            confidence = (1 - gap / window) * math.exp(
+                -haversine_km(before, after) / spread_km
+            )
+            if confidence >= inference.confidence * 0.5:
+                inference = Inference(
+                    path,
+                    interpolate(before, after, fraction),
+                    confidence,
+                    "interpolated",
+                    gap,
+                )
+
+        result.append(inference)
+
+    result.reverse()
+    return result
+
+
+def infer_tree(
+    root: Path | str,
+    catalog: Catalog | None = None,
+    recursive: bool = True,
+    window: float = default_window,
+    interpolation: bool = True,
+) -> list[Inference]:
+    catalog = catalog or get_catalog()
+    return infer_locations(catalog.iter_records(root, recursive), window, interpolation)
+
+
+def sidecar_data(
+    inferences: Iterable[Inference], min_confidence: float = 0.0
+) -> list[tuple[str, float, float]]:
+    """
+    Converts the inferences into the entries expected by create_sidecars
+    """
+    return [
+        (inference.path, *inference.coordinates)
+        for inference in inferences
+        if inference.confidence >= min_confidence
+    ]
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("root", type=Path)
+    parser.add_argument(
+        "--window", type=float, default=default_window / 60, help="minutes"
+    )
+    parser.add_argument("--no-interpolation", action="store_true")
+    parser.add_argument("--not-recursive", action="store_true")
+    parser.add_argument("--min-confidence", type=float, default=0.5)
+    parser.add_argument("--scan", action="store_true", help="update the catalog first")
+    parser.add_argument("--apply", action="store_true", help="write the sidecars")
+    parser.add_argument(
+        "--embedded", action="store_true", help="write into the images, not sidecars"
+    )
+    parser.add_argument(
+        "--preserve-mtime", action="store_true", help="keep the images modified time"
+    )
+    args = parser.parse_args(argv)
+
+    catalog = get_catalog()
+    root = args.root.resolve()
+    if args.scan:
+        catalog.scan_tree(root)
+
+    inferences = infer_tree(
+        root,
+        catalog,
+        not args.not_recursive,
+        args.window * 60,
+        not args.no_interpolation,
+    )
+    for inference in inferences:
+        print(
+            f"{inference.path}\t{inference.coordinates.latitude:.6f}\t"
+            f"{inference.coordinates.longitude:.6f}\t{inference.confidence:.2f}\t"
+            f"{inference.method}"
+        )
+
+    data = sidecar_data(inferences, args.min_confidence)
+    print(
+        f"{len(data)} of {len(inferences)} photos above confidence {args.min_confidence}"
+    )
+    if args.apply:
+        journal = run_job(
+            data, embedded=args.embedded, preserve_mtime=args.preserve_mtime
+        )
+        target = "Images" if args.embedded else "Sidecars"
+        print(f"{target} written, job {journal.id}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
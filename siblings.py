@@ -0,0 +1,92 @@
+"""
+Grouping of the files of one capture, like IMG_1234.DNG + IMG_1234.JPG and an
+edited IMG_1234.psd, so their metadata is read once and their sidecars are
+written in one pass.
+
+Files are siblings when they share folder and name and their modification
+times, written by the camera at capture and kept by imports, match within
+capture_tolerance. Edited formats are accepted regardless of time, as they are
+saved later. Comparing the exif capture times instead would mean reading every
+file, which is what the grouping avoids.
+"""
+
+import os
+from pathlib import Path
+from typing import Iterable
+
+# relative cost of reading the metadata, the cheapest member of a group is the
+# one read for the whole group
+read_cost = {
+    ".jpg": 0,
+    ".jpeg": 0,
+    ".png": 1,
+    ".tif": 2,
+    ".dng": 3,
+    ".psd": 4,
+    ".mov": 5,
+    ".mpg": 5,
+}
+edit_extensions = [".psd"]
+capture_tolerance = 10.0
+
+
+def sibling_key(file: Path) -> tuple[str, str]:
+    return str(file.parent), file.stem.lower()
+
+
+def _stat(file: Path) -> tuple[int, float] | None:
+    try:
+        stat = os.stat(file)
+        return stat.st_size, stat.st_mtime
+    except OSError:
+        return None
+
+
+def group_siblings(
+    files: Iterable[Path], stats: dict[Path, tuple[int, float]] | None = None
+) -> list[list[Path]]:
+    """
+    Splits the files into groups of siblings, each sorted from the cheapest
+    member to read ( smallest of the cheapest format ) to the most expensive.
+    stats can provide the ( size, mtime ) of the files to avoid the stat calls
+    """
+    groups: dict[tuple[str, str], list[Path]] = {}
+    for file in files:
+        groups.setdefault(sibling_key(file), []).append(file)
+
+    result = []
+    for members in groups.values():
+        if len(members) == 1:
+            result.append(members)
+            continue
+
+        info = {
+            member: (stats.get(member) if stats else None) or _stat(member)
+            for member in members
+        }
+        for member in [member for member in members if info[member] is None]:
+            members.remove(member)
+            result.append([member])
+
+        if not members:
+            continue
+
+        members.sort(
+            key=lambda member: (
+                read_cost.get(member.suffix.lower(), 9),
+                info[member][0],
+            )
+        )
+        primary_mtime = info[members[0]][1]
+        group = [members[0]]
+        for member in members[1:]:
+            if (
+                member.suffix.lower() in edit_extensions
+                or abs(info[member][1] - primary_mtime) <= capture_tolerance
+            ):
+                group.append(member)
+            else:
+                result.append([member])
+        result.append(group)
+
+    return result
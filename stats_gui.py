@@ -0,0 +1,74 @@
+from PySide6 import QtCore, QtWidgets, QtGui
+from __feature__ import snake_case, true_property
+import instrumentation
+
+
+class StatsWindow(QtWidgets.QDialog):
+    """
+    Shows the instrumentation counters, latencies and cache hit rates,
+    refreshed every second while open
+    """
+
+    def __init__(
+        self,
+        parent: QtWidgets.QWidget | None = None,
+        f: QtCore.Qt.WindowType = QtCore.Qt.WindowType.Dialog,
+    ) -> None:
+        super().__init__(parent, f)
+
+        self.window_title = "Smart Geo Tag - Statistics"
+
+        layout = QtWidgets.QVBoxLayout()
+
+        self.chk_enabled = QtWidgets.QCheckBox("Collect statistics")
+        self.chk_enabled.checked = instrumentation.enabled
+        self.chk_enabled.toggled.connect(instrumentation.enable)
+        layout.add_widget(self.chk_enabled)
+
+        self.txt_stats = QtWidgets.QPlainTextEdit()
+        self.txt_stats.read_only = True
+        self.txt_stats.font = QtGui.QFontDatabase.system_font(
+            QtGui.QFontDatabase.SystemFont.FixedFont
+        )
+        layout.add_widget(self.txt_stats)
+
+        buttons = QtWidgets.QHBoxLayout()
+
+        btn_reset = QtWidgets.QPushButton("Reset")
+        btn_reset.clicked.connect(self.reset)
+        buttons.add_widget(btn_reset)
+
+        btn_export = QtWidgets.QPushButton("Export...")
+        btn_export.clicked.connect(self.export)
+        buttons.add_widget(btn_export)
+
+        layout.add_layout(buttons)
+        self.set_layout(layout)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.interval = 1000
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start()
+
+        self.refresh()
+        self.resize(700, 500)
+
+    @QtCore.Slot()
+    def refresh(self):
+        self.txt_stats.plain_text = instrumentation.summary()
+
+    @QtCore.Slot()
+    def reset(self):
+        instrumentation.reset()
+        self.refresh()
+
+    @QtCore.Slot()
+    def export(self):
+        path, _ = QtWidgets.QFileDialog.get_save_file_name(
+            self,
+            "Export statistics",
+            "smartgeotag_trace.json",
+            "Chrome trace (*.json);;Prometheus text (*.prom *.txt)",
+        )
+        if path:
+            instrumentation.export(path)
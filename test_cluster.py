@@ -0,0 +1,77 @@
+from pathlib import Path
+
+import pytest
+
+from benchmark import jpeg_data
+from catalog import Catalog
+from cluster import cluster_points, geo_bounds, spherical_center, suggest_locations
+from geo import Coordinates
+
+
+def test_cluster_points():
+    turin = [Coordinates(45.07 + i * 0.001, 7.68) for i in range(5)]
+    paris = [Coordinates(48.85, 2.35 + i * 0.001) for i in range(5)]
+    alone = [Coordinates(0.0, 0.0)]
+
+    labels = cluster_points(turin + paris + alone, eps_km=1, min_points=3)
+
+    assert len(set(labels[:5])) == 1
+    assert len(set(labels[5:10])) == 1
+    assert -1 < labels[0] != labels[5] > -1
+    assert labels[10] == -1
+
+
+def test_antimeridian():
+    points = [Coordinates(-17.0, 179.5), Coordinates(-18.0, -179.5)]
+
+    center = spherical_center(points)
+    south_west, north_east = geo_bounds(points)
+
+    assert abs(center.longitude) == pytest.approx(180.0, abs=0.01)
+    assert center.latitude == pytest.approx(-17.5, abs=0.01)
+    assert (south_west.longitude, north_east.longitude) == (179.5, -179.5)
+    assert cluster_points(points, eps_km=200, min_points=2) == [0, 0]
+
+
+def write_images(
+    folder: Path, count: int, coordinates: Coordinates | None, day: int = 1
+):
+    folder.mkdir(parents=True)
+    for number in range(count):
+        (folder / f"{number}.jpg").write_bytes(
+            jpeg_data(coordinates, f"2020:01:{day:02} 10:{number:02}:00")
+        )
+
+
+def test_suggest_locations(tmp_path: Path):
+    root = tmp_path / "photos"
+    turin = Coordinates(45.07, 7.68)
+    write_images(root / "turin", 3, turin)
+    (root / "turin" / "3.jpg").write_bytes(jpeg_data(None, "2020:01:01 10:03:00"))
+    write_images(root / "same day", 2, None)
+    write_images(root / "weeks later", 2, None, day=20)
+    (root / "disagree").mkdir()
+    (root / "disagree" / "0.jpg").write_bytes(
+        jpeg_data(Coordinates(10.0, 10.0), "2021:01:01 10:00:00")
+    )
+    (root / "disagree" / "1.jpg").write_bytes(
+        jpeg_data(Coordinates(-10.0, -10.0), "2021:01:01 11:00:00")
+    )
+    (root / "disagree" / "2.jpg").write_bytes(jpeg_data(None, "2021:01:01 12:00:00"))
+
+    catalog = Catalog(tmp_path / "catalog.sqlite3")
+    catalog.scan_tree(root)
+
+    suggestions = {
+        Path(suggestion.folder).name: suggestion
+        for suggestion in suggest_locations(root, catalog)
+    }
+
+    assert set(suggestions) == {"turin", "same day"}
+    assert suggestions["turin"].source == "folder"
+    assert suggestions["turin"].confidence == 1.0
+    assert suggestions["turin"].paths == [str(root / "turin" / "3.jpg")]
+    assert suggestions["turin"].coordinates == pytest.approx(turin)
+    assert suggestions["same day"].source == "event"
+    assert suggestions["same day"].coordinates == pytest.approx(turin)
+    assert len(suggestions["same day"].paths) == 2
@@ -0,0 +1,91 @@
+import os
+from pathlib import Path
+
+import pytest
+from pyexiv2 import Image
+
+from benchmark import jpeg_data
+from embedded import (
+    has_coordinates,
+    patch_gps,
+    restore_embedded_gps,
+    write_embedded_gps,
+)
+from geo import GPS, Coordinates, gps_coordinates, read_metadata
+
+date_time = "2020:01:01 10:00:00"
+
+
+def gps_tags(file: Path) -> dict[str, str]:
+    with Image(str(file)) as image:
+        return {
+            key: value
+            for key, value in image.read_exif().items()
+            if key.startswith("Exif.GPSInfo.")
+        }
+
+
+def coordinates(file: Path) -> Coordinates | None:
+    return gps_coordinates(read_metadata(file)[0])
+
+
+@pytest.fixture
+def tagged(tmp_path: Path) -> Path:
+    file = tmp_path / "tagged.jpg"
+    file.write_bytes(jpeg_data(Coordinates(10.0, 20.0), date_time))
+    return file
+
+
+@pytest.fixture
+def untagged(tmp_path: Path) -> Path:
+    file = tmp_path / "untagged.jpg"
+    file.write_bytes(jpeg_data(None, date_time))
+    return file
+
+
+def test_patch_in_place_and_restore(tagged: Path):
+    size = tagged.stat().st_size
+    original = gps_tags(tagged)
+
+    status, prior = write_embedded_gps(tagged, -33.5, 151.25, overwrite=True)
+
+    assert status == "written"
+    assert tagged.stat().st_size == size
+    assert coordinates(tagged) == pytest.approx((-33.5, 151.25), abs=1e-6)
+
+    restore_embedded_gps(tagged, prior)
+    assert gps_tags(tagged) == original
+
+
+def test_rewrite_without_gps_and_restore(untagged: Path):
+    assert patch_gps(untagged, GPS.from_decimal(1.0, 2.0), True) is None
+
+    status, prior = write_embedded_gps(untagged, 45.0, -73.5, overwrite=False)
+
+    assert status == "written"
+    assert prior is None
+    assert coordinates(untagged) == pytest.approx((45.0, -73.5), abs=1e-6)
+
+    restore_embedded_gps(untagged, prior)
+    assert coordinates(untagged) is None
+
+
+def test_skips_tagged_without_overwrite(tagged: Path):
+    content = tagged.read_bytes()
+
+    status, prior = write_embedded_gps(tagged, 1.0, 2.0, overwrite=False)
+
+    assert status == "skipped"
+    assert has_coordinates(prior)
+    assert tagged.read_bytes() == content
+
+
+def test_preserve_mtime(tagged: Path, untagged: Path):
+    for file in (tagged, untagged):
+        os.utime(file, (1_000_000_000, 1_000_000_000))
+
+        _, prior = write_embedded_gps(file, 5.0, 6.0, True, preserve_mtime=True)
+        assert file.stat().st_mtime == 1_000_000_000
+
+        restore_embedded_gps(file, prior, preserve_mtime=True)
+        assert file.stat().st_mtime == 1_000_000_000
@@ -0,0 +1,122 @@
+from pathlib import Path
+
+import pytest
+
+import geo
+from benchmark import jpeg_data, sidecar_data
+from geo import Coordinates, gps_coordinates, read_metadata
+from journal import Journal, resume_job, run_job
+
+date_time = "2020:01:01 10:00:00"
+
+
+def coordinates(file: Path) -> Coordinates | None:
+    return gps_coordinates(read_metadata(file)[0])
+
+
+@pytest.fixture
+def folder(tmp_path: Path) -> Path:
+    """
+    Five images, the odd ones tagged, the first with a sidecar of its own
+    """
+    folder = tmp_path / "images"
+    folder.mkdir()
+    for number in range(5):
+        tagged = Coordinates(10.0 + number, 20.0) if number % 2 else None
+        (folder / f"{number}.jpg").write_bytes(jpeg_data(tagged, date_time))
+    (folder / "0.jpg.xmp").write_text(sidecar_data(Coordinates(1.0, 2.0)))
+    return folder
+
+
+def test_sidecar_job_rollback(folder: Path, tmp_path: Path):
+    existing = (folder / "0.jpg.xmp").read_bytes()
+
+    journal = run_job([(str(folder), 30.0, 40.0)], True, tmp_path / "jobs")
+
+    assert journal.finished
+    assert len(journal.committed) == 5
+    assert coordinates(folder / "0.jpg.xmp") == pytest.approx((30.0, 40.0))
+
+    journal = Journal.open(journal.path)
+    assert journal.rollback() == 5
+    assert (folder / "0.jpg.xmp").read_bytes() == existing
+    assert sorted(path.name for path in folder.glob("*.xmp")) == ["0.jpg.xmp"]
+
+
+def test_rollback_twice(folder: Path, tmp_path: Path):
+    journal = run_job([(str(folder), 30.0, 40.0)], True, tmp_path / "jobs")
+    assert Journal.open(journal.path).rollback() == 5
+
+    (folder / "1.jpg.xmp").write_text(sidecar_data(Coordinates(7.0, 8.0)))
+    journal = Journal.open(journal.path)
+
+    assert journal.rolled_back
+    assert journal.rollback() == 0
+    assert coordinates(folder / "1.jpg.xmp") == pytest.approx((7.0, 8.0))
+
+
+def test_embedded_job_rollback(folder: Path, tmp_path: Path):
+    images = sorted(folder.glob("*.jpg"))
+    original = {image: coordinates(image) for image in images}
+
+    journal = run_job(
+        [(str(folder), 30.0, 40.0)], True, tmp_path / "jobs", embedded=True
+    )
+
+    assert journal.finished
+    assert not journal.priors_logs()
+    assert all(coordinates(image) == pytest.approx((30.0, 40.0)) for image in images)
+
+    assert Journal.open(journal.path).rollback() == 5
+    assert {image: coordinates(image) for image in images} == original
+
+
+def test_embedded_job_resumed_after_crash(folder: Path, tmp_path: Path):
+    """
+    A worker that wrote every image and died before the journal recorded them
+    leaves only its priors log, which the resumed job keeps for the rollback
+    """
+    images = sorted(folder.glob("*.jpg"))
+    original = {image: coordinates(image) for image in images}
+
+    journal = Journal.create(
+        [(str(folder), 30.0, 40.0)], True, tmp_path / "jobs", embedded=True
+    )
+    chunk = [([str(image) for image in images], 30.0, 40.0)]
+    geo.write_chunk(chunk, True, True, False, str(journal.path.with_suffix("")))
+    journal.close()
+    assert journal.priors_logs()
+
+    # the resumed run writes the images again, over their new coordinates
+    journal = resume_job(journal.path)
+
+    assert journal.finished
+    assert not journal.priors_logs()
+
+    assert Journal.open(journal.path).rollback() == 5
+    assert {image: coordinates(image) for image in images} == original
+
+
+def test_interrupted_embedded_job(folder: Path, tmp_path: Path):
+    images = sorted(folder.glob("*.jpg"))
+    original = {image: coordinates(image) for image in images}
+    written = []
+
+    journal = run_job(
+        [(str(folder), 30.0, 40.0)],
+        True,
+        tmp_path / "jobs",
+        embedded=True,
+        progress=lambda total, results: written.extend(results),
+        should_stop=lambda: len(written) >= 2,
+    )
+
+    assert not journal.finished
+    assert len(journal.committed) == 2
+
+    journal = resume_job(journal.path)
+    assert journal.finished
+    assert len(journal.committed) == 5
+
+    assert Journal.open(journal.path).rollback() == 5
+    assert {image: coordinates(image) for image in images} == original
@@ -0,0 +1,84 @@
+import pytest
+
+from catalog import Record
+from geo import Coordinates
+from propagation import infer_locations, interpolate, sidecar_data
+
+
+def record(
+    name: str, taken: str | None, coordinates: Coordinates | None = None
+) -> Record:
+    latitude, longitude = coordinates if coordinates else (None, None)
+    return Record(
+        f"/photos/{name}.jpg", name, ".jpg", 1000, 0.0, taken, latitude, longitude, True
+    )
+
+
+def test_nearest_within_window():
+    records = [
+        record("a", "2020-01-01 10:00:00", Coordinates(45.0, 7.0)),
+        record("b", "2020-01-01 10:10:00"),
+        record("c", "2020-01-01 12:00:00"),
+    ]
+
+    [inference] = infer_locations(records, window=30 * 60)
+
+    assert inference.path == "/photos/b.jpg"
+    assert inference.coordinates == (45.0, 7.0)
+    assert inference.method == "nearest"
+    assert inference.gap == 600
+    assert inference.confidence == pytest.approx(2 / 3)
+
+
+def test_interpolates_between_close_neighbours():
+    records = [
+        record("a", "2020-01-01 10:00:00", Coordinates(45.0, 7.0)),
+        record("b", "2020-01-01 10:05:00"),
+        record("c", "2020-01-01 10:20:00", Coordinates(45.01, 7.01)),
+    ]
+
+    [inference] = infer_locations(records)
+
+    assert inference.method == "interpolated"
+    assert inference.coordinates == pytest.approx((45.0025, 7.0025))
+
+
+def test_keeps_nearest_when_neighbours_are_far_apart():
+    records = [
+        record("a", "2020-01-01 10:00:00", Coordinates(45.0, 7.0)),
+        record("b", "2020-01-01 10:05:00"),
+        record("c", "2020-01-01 10:20:00", Coordinates(48.0, 2.0)),
+    ]
+
+    [inference] = infer_locations(records)
+
+    assert inference.method == "nearest"
+    assert inference.coordinates == (45.0, 7.0)
+
+
+def test_ignores_unscanned_and_undated():
+    records = [
+        record("a", "2020-01-01 10:00:00", Coordinates(45.0, 7.0)),
+        record("b", None),
+        record("c", "2020-01-01 10:01:00")._replace(scanned=False),
+    ]
+
+    assert infer_locations(records) == []
+
+
+def test_interpolate_across_antimeridian():
+    middle = interpolate(Coordinates(0.0, 179.0), Coordinates(0.0, -179.0), 0.5)
+
+    assert abs(middle.longitude) == pytest.approx(180.0)
+
+
+def test_sidecar_data_min_confidence():
+    records = [
+        record("a", "2020-01-01 10:00:00", Coordinates(45.0, 7.0)),
+        record("b", "2020-01-01 10:01:00"),
+        record("c", "2020-01-01 10:25:00"),
+    ]
+
+    data = sidecar_data(infer_locations(records), min_confidence=0.5)
+
+    assert data == [("/photos/b.jpg", 45.0, 7.0)]
@@ -0,0 +1,398 @@
+"""
+Thumbnails of the images from the previews embedded in their metadata.
+
+The JPEG previews referenced by the exif / tiff directories are located by
+reading only the file header, so DNG and TIFF files are never decoded, and are
+decoded at a reduced size on a pool of worker threads. Decoded thumbnails are
+kept in memory up to memory_limit bytes, least recently used first out, and on
+disk keyed by path and modification time, so they survive restarts and are
+refreshed when a file changes.
+"""
+
+import hashlib
+import html
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, NamedTuple
+
+from PySide6 import QtCore, QtGui
+from __feature__ import snake_case, true_property
+from pyexiv2 import Image as ImageExiv2
+
+import instrumentation
+
+cache_path = Path(
+    os.environ.get(
+        "SMARTGEOTAG_THUMBNAILS", Path.home() / ".smartgeotag" / "thumbnails"
+    )
+)
+
+thumbnail_size = 320
+icon_size = 48
+memory_limit = 64 * 1024 * 1024
+# previews above this size are full resolution images, not worth reading
+max_preview_bytes = 4 * 1024 * 1024
+# the smallest preview at least this large is used, as smaller ones are
+# usually 160 pixel exif thumbnails
+min_preview_bytes = 16 * 1024
+# formats decoded directly when they have no embedded preview
+direct_extensions = [".jpg", ".jpeg", ".png"]
+popup_width = 200
+max_ifds = 16
+
+# new subfile type, compression, strip offsets, orientation, strip byte counts,
+# sub ifds, jpeg offset, jpeg length
+preview_tags = {0x00FE, 0x0103, 0x0111, 0x0112, 0x0117, 0x014A, 0x0201, 0x0202}
+
+rotations = {3: 180, 6: 90, 8: 270}
+
+
+def _ifd_values(
+    file: BinaryIO, base: int, order: str, entry: bytes
+) -> tuple[int, list[int]] | None:
+    tag, kind, amount = struct.unpack_from(order + "HHI", entry)
+    if tag not in preview_tags or kind not in (3, 4, 13) or amount > 64:
+        return None
+
+    size = 2 if kind == 3 else 4
+    if amount * size <= 4:
+        raw = entry[8 : 8 + amount * size]
+    else:
+        (pointer,) = struct.unpack_from(order + "I", entry, 8)
+        file.seek(base + pointer)
+        raw = file.read(amount * size)
+        if len(raw) < amount * size:
+            return None
+
+    return tag, list(struct.unpack(order + ("H" if size == 2 else "I") * amount, raw))
+
+
+def tiff_previews(file: BinaryIO, base: int = 0) -> tuple[list[tuple[int, int]], int]:
+    """
+    ( offset, length ) of the JPEG previews referenced by the directories of
+    the tiff structure starting at base, and the orientation of the image
+    """
+    file.seek(base)
+    header = file.read(8)
+    if len(header) < 8 or header[:2] not in (b"II", b"MM"):
+        return [], 1
+
+    order = "<" if header[:2] == b"II" else ">"
+    magic, first = struct.unpack(order + "HI", header[2:])
+    if magic != 42:
+        return [], 1
+
+    previews = []
+    orientation = 1
+    queue, seen = [first], set()
+    while queue and len(seen) < max_ifds:
+        offset = queue.pop(0)
+        if not offset or offset in seen:
+            continue
+        seen.add(offset)
+
+        file.seek(base + offset)
+        data = file.read(2)
+        if len(data) < 2:
+            continue
+        (count,) = struct.unpack(order + "H", data)
+        entries = file.read(count * 12 + 4)
+        if len(entries) < count * 12 + 4:
+            continue
+
+        tags = {}
+        for i in range(count):
+            values = _ifd_values(file, base, order, entries[i * 12 : i * 12 + 12])
+            if values:
+                tags[values[0]] = values[1]
+
+        queue.append(struct.unpack_from(order + "I", entries, count * 12)[0])
+        queue.extend(tags.get(0x014A, []))
+
+        if len(seen) == 1 and 0x0112 in tags:
+            orientation = tags[0x0112][0]
+
+        if 0x0201 in tags and 0x0202 in tags:
+            previews.append((base + tags[0x0201][0], tags[0x0202][0]))
+        elif (
+            # reduced resolution images stored as a single JPEG strip, the full
+            # resolution raw data is left out
+            tags.get(0x00FE, [0])[0] & 1
+            and tags.get(0x0103, [0])[0] in (6, 7)
+            and len(tags.get(0x0111, [])) == 1
+            and len(tags.get(0x0117, [])) == 1
+        ):
+            previews.append((base + tags[0x0111][0], tags[0x0117][0]))
+
+    return previews, orientation
+
+
+def jpeg_previews(file: BinaryIO) -> tuple[list[tuple[int, int]], int]:
+    """
+    Previews of a JPEG file, found in the exif segment before the image data
+    """
+    file.seek(2)
+    while True:
+        marker = file.read(4)
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            return [], 1
+
+        (length,) = struct.unpack(">H", marker[2:])
+        segment = file.tell()
+        if marker[1] == 0xE1 and file.read(6) == b"Exif\x00\x00":
+            return tiff_previews(file, segment + 6)
+
+        file.seek(segment + length - 2)
+
+
+def embedded_preview(path: Path | str) -> tuple[bytes | None, int]:
+    """
+    JPEG preview embedded in the image, read without decoding the image, and
+    the orientation to apply to it
+    """
+    with open(path, "rb") as file:
+        start = file.read(2)
+        if start == b"\xff\xd8":
+            previews, orientation = jpeg_previews(file)
+        elif start in (b"II", b"MM"):
+            previews, orientation = tiff_previews(file)
+        else:
+            previews, orientation = [], 1
+
+        previews = sorted(
+            (preview for preview in previews if 0 < preview[1] <= max_preview_bytes),
+            key=lambda preview: preview[1],
+        )
+        large = [preview for preview in previews if preview[1] >= min_preview_bytes]
+        for offset, length in large[:1] or previews[-1:]:
+            file.seek(offset)
+            data = file.read(length)
+            if data[:2] == b"\xff\xd8":
+                return data, orientation
+
+    if Path(path).suffix.lower() not in direct_extensions:
+        # other formats, like psd, through exiv2
+        try:
+            with ImageExiv2(str(path)) as image:
+                return image.read_thumbnail() or None, 1
+        except Exception:
+            pass
+
+    return None, 1
+
+
+def decode(data: bytes | QtCore.QIODevice | str, orientation: int = 1) -> QtGui.QImage:
+    """
+    Decodes an image scaled down to thumbnail_size, letting the JPEG decoder
+    skip the detail that is not needed
+    """
+    if isinstance(data, bytes):
+        device = QtCore.QBuffer()
+        device.set_data(QtCore.QByteArray(data))
+        reader = QtGui.QImageReader(device)
+    else:
+        reader = QtGui.QImageReader(data)
+        reader.set_auto_transform(True)
+
+    size = reader.size()
+    if size.is_valid() and max(size.width(), size.height()) > thumbnail_size:
+        reader.set_scaled_size(
+            size.scaled(
+                thumbnail_size,
+                thumbnail_size,
+                QtCore.Qt.AspectRatioMode.KeepAspectRatio,
+            )
+        )
+
+    image = reader.read()
+    if not image.is_null() and orientation in rotations:
+        image = image.transformed(QtGui.QTransform().rotate(rotations[orientation]))
+
+    return image
+
+
+def cache_file(path: str, mtime: float) -> Path:
+    key = hashlib.blake2b(f"{path}\n{mtime}".encode(), digest_size=16).hexdigest()
+    return cache_path / key[:2] / f"{key}.jpg"
+
+
+def load_thumbnail(path: str, mtime: float) -> QtGui.QImage:
+    """
+    Thumbnail of an image from the disk cache, or from its embedded preview,
+    storing it in the cache. Images without preview get an empty cache file so
+    they are not read again, and a null image
+    """
+    file = cache_file(path, mtime)
+    try:
+        if file.stat().st_size == 0:
+            instrumentation.cache_access("thumbnails_disk", True)
+            return QtGui.QImage()
+        image = QtGui.QImage(str(file))
+        if not image.is_null():
+            instrumentation.cache_access("thumbnails_disk", True)
+            return image
+    except OSError:
+        pass
+
+    instrumentation.cache_access("thumbnails_disk", False)
+
+    try:
+        data, orientation = embedded_preview(path)
+        if data:
+            image = decode(data, orientation)
+        elif Path(path).suffix.lower() in direct_extensions:
+            image = decode(path)
+        else:
+            image = QtGui.QImage()
+    except Exception as e:
+        print(f"Error reading preview of {path}: {e}")
+        return QtGui.QImage()
+
+    try:
+        file.parent.mkdir(parents=True, exist_ok=True)
+        temporary = file.with_suffix(f".{os.getpid()}.tmp")
+        if image.is_null():
+            temporary.write_bytes(b"")
+        else:
+            image.save(str(temporary), "JPG", 85)
+        os.replace(temporary, file)
+    except Exception as e:
+        print(f"Error caching thumbnail of {path}: {e}")
+
+    return image
+
+
+class Thumbnail(NamedTuple):
+    image: QtGui.QImage
+    icon: QtGui.QPixmap
+
+    @property
+    def size(self) -> int:
+        return self.image.size_in_bytes() + self.icon.width() * self.icon.height() * 4
+
+
+class ThumbnailSignals(QtCore.QObject):
+    loaded = QtCore.Signal(str, float, QtGui.QImage, QtGui.QImage)
+
+
+class ThumbnailWorker(QtCore.QRunnable):
+    """
+    Loads the thumbnail of an image and scales its table icon in a pool thread
+    """
+
+    def __init__(self, path: str, mtime: float, signals: ThumbnailSignals):
+        super().__init__()
+        self.path = path
+        self.mtime = mtime
+        self.signals = signals
+
+    def run(self):
+        image = load_thumbnail(self.path, self.mtime)
+        icon = (
+            image
+            if image.is_null()
+            else image.scaled(
+                icon_size,
+                icon_size,
+                QtCore.Qt.AspectRatioMode.KeepAspectRatio,
+                QtCore.Qt.TransformationMode.SmoothTransformation,
+            )
+        )
+        self.signals.loaded.emit(self.path, self.mtime, image, icon)
+
+
+class ThumbnailLoader(QtCore.QObject):
+    """
+    Provides the thumbnails from memory, loading the missing ones in the
+    background and emitting loaded once they are available. The latest
+    requests, for the rows on screen, are served first
+    """
+
+    loaded = QtCore.Signal(str)
+
+    def __init__(self, parent: QtCore.QObject | None = None):
+        super().__init__(parent)
+        self.cache: OrderedDict[tuple[str, float], Thumbnail] = OrderedDict()
+        self.cache_size = 0
+        self.pending: dict[tuple[str, float], ThumbnailWorker] = {}
+        self.priority = 0
+        self.signals = ThumbnailSignals()
+        self.signals.loaded.connect(self.thumbnail_loaded)
+        self.pool = QtCore.QThreadPool(self)
+        self.pool.max_thread_count = max(1, min(4, QtCore.QThread.ideal_thread_count()))
+
+        app = QtCore.QCoreApplication.instance()
+        if app:
+            app.aboutToQuit.connect(self.cancel)
+
+    def get(self, path: str, mtime: float) -> Thumbnail | None:
+        """
+        Thumbnail of the image if it is in memory, otherwise requests it and
+        returns None
+        """
+        key = (path, mtime)
+        thumbnail = self.cache.get(key)
+        instrumentation.cache_access("thumbnails_memory", thumbnail is not None)
+        if thumbnail is not None:
+            self.cache.move_to_end(key)
+            return thumbnail
+
+        self.request(path, mtime)
+        return None
+
+    def request(self, path: str, mtime: float):
+        key = (path, mtime)
+        if key in self.pending or key in self.cache:
+            return
+
+        worker = ThumbnailWorker(path, mtime, self.signals)
+        worker.set_auto_delete(False)
+        self.pending[key] = worker
+        self.priority = (self.priority + 1) % 0x7FFFFFFF
+        self.pool.start(worker, self.priority)
+
+    def cancel(self):
+        """
+        Drops the requests not started yet, like the ones for rows scrolled
+        past or for a folder no longer shown
+        """
+        self.pool.clear()
+        self.pending.clear()
+
+    def thumbnail_loaded(
+        self, path: str, mtime: float, image: QtGui.QImage, icon: QtGui.QImage
+    ):
+        key = (path, mtime)
+        self.pending.pop(key, None)
+        if key in self.cache:
+            return
+
+        thumbnail = Thumbnail(image, QtGui.QPixmap.from_image(icon))
+        self.cache[key] = thumbnail
+        self.cache_size += thumbnail.size
+        while self.cache_size > memory_limit and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_size -= evicted.size
+
+        self.loaded.emit(path)
+
+
+def popup_html(path: str, mtime: float, name: str) -> str | None:
+    """
+    Map popup showing the cached thumbnail of an image, None when it is not
+    cached yet. The thumbnail is linked rather than embedded, to keep the map
+    page small
+    """
+    file = cache_file(path, mtime)
+    try:
+        if not file.stat().st_size:
+            return None
+    except OSError:
+        return None
+
+    return (
+        f'<img src="{html.escape(file.resolve().as_uri())}" '
+        f'width="{popup_width}"><br>{html.escape(name)}'
+    )
@@ -0,0 +1,64 @@
+import importlib
+import json
+import os
+import sys
+from time import perf_counter, time
+from types import ModuleType
+
+_start = perf_counter()
+_marks: list[tuple[str, float]] = []
+_imports: list[tuple[str, float]] = []
+
+# SMARTGEOTAG_TIMING=1 prints the report to stderr, any other value is taken as
+# a file path and the report is appended to it as a json line
+target = os.environ.get("SMARTGEOTAG_TIMING", "")
+
+
+def mark(name: str):
+    """
+    Records the time elapsed since startup under the given name
+    """
+    _marks.append((name, perf_counter() - _start))
+
+
+def timed_import(name: str) -> ModuleType:
+    """
+    Imports a module recording how long the import took. Modules already loaded
+    are returned without being recorded, still going through the import
+    machinery so a module another thread is importing is waited for
+    """
+    loaded = name in sys.modules
+
+    begin = perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        _imports.append((name, perf_counter() - begin))
+
+    return module
+
+
+def report() -> dict:
+    return {
+        "timestamp": time(),
+        "marks": {name: round(value * 1000, 3) for name, value in _marks},
+        "imports": {name: round(value * 1000, 3) for name, value in _imports},
+    }
+
+
+def write_report():
+    if not target:
+        return
+
+    data = report()
+
+    if target == "1":
+        for section in ["marks", "imports"]:
+            for name, value in data[section].items():
+                print(f"{section[:-1]:>6} {name:<30} {value:10.1f} ms", file=sys.stderr)
+        return
+
+    try:
+        with open(target, "a") as file:
+            file.write(json.dumps(data) + "\n")
+    except Exception as e:
+        print(f"Error writing timing report to {target}: {e}")